@@ -20,6 +20,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import ntris.zobrist as zobrist
+
+from collections import OrderedDict
+import itertools
 import numpy as np
 import random
 import pygame
@@ -41,6 +45,53 @@ def block_sprite_init(looks, mask):
     del a
     mask.unlock()
 
+class SpriteCache:
+    """
+    SpriteCache - an LRU cache of finished block sprites.
+    
+      Sprites are keyed by (size, color, shaded, flashing). Once 'maxsize'
+      sprites are stored, the least recently drawn one is dropped.
+    
+    Methods:
+      __init__(maxsize=256)
+      get(key, make) : the sprite stored under 'key'; on a miss it's built
+                       by make() and stored
+      reserve(n)     : makes room for at least 'n' sprites
+      clear()        : drops every sprite, e.g. when the cell size changes
+    
+    Attributes:
+      hits, misses, evictions : counters
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.sprites = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+    
+    def __len__(self):
+        return len(self.sprites)
+    
+    def get(self, key, make):
+        sprite = self.sprites.get(key)
+        if sprite is not None:
+            self.sprites.move_to_end(key)
+            self.hits+= 1
+            return sprite
+        self.misses+= 1
+        sprite = make()
+        self.sprites[key] = sprite
+        if len(self.sprites) > self.maxsize:
+            self.sprites.popitem(last=False)
+            self.evictions+= 1
+        return sprite
+    
+    def reserve(self, n):
+        # An LRU smaller than the set of sprites drawn over and over misses
+        # on every single one of them.
+        self.maxsize = max(self.maxsize, n)
+    
+    def clear(self):
+        self.sprites.clear()
+
 class Block:
     """
     Block - a basic rectangular object that gets drawn on screen. It's fully
@@ -48,6 +99,9 @@ class Block:
       passed to the 'draw' function. The texture it uses is tied directly
       to the class and is not changed during the game.
       
+      Finished sprites are kept in Block.SPRITES, so a block is only
+      scaled and tinted the first time its size and look come up.
+      
     Methods:
       __init__(col)
       __init__(Block)
@@ -59,6 +113,7 @@ class Block:
     LOOKS = pygame.image.load("assets/sprites/block.png")
     MASK  = pygame.Surface(LOOKS.get_size(), 0, LOOKS)
     block_sprite_init(LOOKS, MASK)
+    SPRITES = SpriteCache()
 
     def __init__(self, *args):
         """
@@ -87,7 +142,18 @@ class Block:
             self.scale = 1.0
     
     def draw(self, surface):
-        wh = surface.get_size()
+        surface.blit(self.sprite(surface.get_size()), (0,0))
+    
+    def look(self):
+        # Everything but the size a sprite depends on.
+        if self.flashing:
+            return (None, False, True)
+        return (tuple(self.col), self.shaded, False)
+    
+    def sprite(self, wh):
+        return Block.SPRITES.get((wh,) + self.look(), lambda: self._render(wh))
+    
+    def _render(self, wh):
         img  = pygame.transform.smoothscale(Block.LOOKS, wh)
         if not self.flashing:
             tint = pygame.Surface(wh, 0, Block.LOOKS)
@@ -101,7 +167,7 @@ class Block:
             img.blit(tint, (0,0), None, BLEND_RGB_MULT)
         else:
             img.fill([255,255,255,200])
-        surface.blit(img, (0,0))
+        return img
         
     def disable(self):
         self.shaded = True
@@ -118,10 +184,89 @@ class BlockArray:
     """
     BlockArray - stores essential data about blocks lying on stage, i.e.
       color and positions on evenly-spaced grid of possible block positions.
+      
+      Next to the blocks, every row keeps an int bitmask of its occupied
+      cells (bit x for column x), so that collision tests take one
+      shift-and-AND per row of a piece and a full row is a single compare.
+      
+      Snapshots share rows with the array (copy-on-write): a snapshot costs
+      one copy of the row pointers, and the first write to a row after a
+      snapshot or restore copies that row only. Blocks inside rows are
+      never modified in place.
+      
+      'zobrist' is a 64-bit hash of the occupied cells, kept current by
+      every mutation (see ntris.zobrist); 'rowhash' holds the hashes of
+      the single rows.
+    
+    Methods:
+      collides(masks, x, y) : True if a piece whose row y+i has the cells
+                              'masks[i]' << x overlaps a block or the edges
+      row_mask(y)
+      full_rows(rows=None)
+      flash_row(y)          : toggles flashing of the blocks in row y
+      snapshot()
+      restore(snapshot)
+      cells()               : yields (x, y, block) in row-major order
+      fill(blocks)
     """
     def __init__(self, size, rect):
         self.size = tuple(size)[0:2]
         self.array = [[None]*size[0] for x in range(size[1])]
+        self.masks = [0]*size[1]
+        self.full  = (1 << size[0]) - 1
+        self._owned = [True]*size[1]
+        self.rowhash = [0]*size[1]
+        self.zobrist = 0
+    
+    def _occupy(self, x, y):
+        # Bookkeeping for a block put at (x,y): row mask and hashes.
+        bit = 1 << x
+        if not self.masks[y] & bit:
+            self.masks[y] |= bit
+            height = self.size[1]-1-y
+            old = self.rowhash[y]
+            self.rowhash[y] ^= zobrist.column_key(x)
+            self.zobrist ^= zobrist.mix_row(old, height) ^ \
+                            zobrist.mix_row(self.rowhash[y], height)
+    
+    def _rehash(self):
+        self.rowhash = [zobrist.row_hash(m) for m in self.masks]
+        self.zobrist = zobrist.board_hash(self.rowhash)
+    
+    def _delete_hash(self, i):
+        # Row i is gone and an empty row came in on top; only the rows
+        # above i changed height.
+        z = self.zobrist
+        rowhash, h = self.rowhash, self.size[1]
+        z ^= zobrist.mix_row(rowhash[i], h-1-i)
+        for y in range(i):
+            if rowhash[y]:
+                z ^= zobrist.mix_row(rowhash[y], h-1-y) ^ \
+                     zobrist.mix_row(rowhash[y], h-2-y)
+        del rowhash[i]
+        rowhash[:0] = [0]
+        self.zobrist = z
+    
+    def _own(self, y):
+        # Makes row y private to this array before it is written to.
+        if not self._owned[y]:
+            self.array[y] = self.array[y].copy()
+            self._owned[y] = True
+    
+    def snapshot(self):
+        self._owned = [False]*self.size[1]
+        return (self.size, tuple(self.array), tuple(self.masks),
+                tuple(self.rowhash), self.zobrist)
+    
+    def restore(self, snapshot):
+        size, array, masks, rowhash, z = snapshot
+        self.rowhash = list(rowhash)
+        self.zobrist = z
+        self.size  = size
+        self.array = list(array)
+        self.masks = list(masks)
+        self.full  = (1 << size[0]) - 1
+        self._owned = [False]*size[1]
     
     def __getitem__(self, key):
         if isinstance(key, tuple) and len(key) == 2 and \
@@ -136,7 +281,9 @@ class BlockArray:
             val = Block(val)
         if isinstance(key, tuple) and len(key) == 2 and \
            all(isinstance(x,int) for x in key):
+            self._own(key[1])
             self.array[key[1]][key[0]] = val
+            self._occupy(*key)
         else:
             raise KeyError("invalid index ({})".format(key))
     
@@ -161,6 +308,7 @@ class BlockArray:
         copy = lambda x: [Block(b) if b else None for b in x]
         for i,a in enumerate(self.array):
             a = a.copy()
+            self.array[i] = a.copy()
             copies, rest = divmod(byx, sx)
             first = -byx + copies * sx
             last  =  byx + copies * (sx+1)
@@ -170,16 +318,66 @@ class BlockArray:
             self.array[i][:0] =  copy(a[-rest:])
         self.array[:0] = [[None]*(sx+2*byx) for x in range(byy)]
         self.size = (sx+2*byx, sy+byy)
+        self.full = (1 << self.size[0]) - 1
+        self.masks = [0]*byy + [self._tile(m, sx, byx) for m in self.masks]
+        self._owned = [True]*self.size[1]
+        self._rehash()
+    
+    @staticmethod
+    def _tile(mask, sx, byx):
+        # Row mask after 'expand': the old row repeated periodically over
+        # byx new columns on either side.
+        copies, rest = divmod(byx, sx)
+        ret = mask & ((1 << rest) - 1)
+        for i in range(copies):
+            ret = (ret << sx) | mask
+        ret = (ret << sx) | mask
+        for i in range(copies):
+            ret = (ret << sx) | mask
+        return (ret << rest) | (mask >> (sx-rest))
     
     def delete_row(self, i):
+        self._delete_hash(i)
         del self.array[i]
         self.array[:0] = [[None]*self.size[0]]
+        del self.masks[i]
+        self.masks[:0] = [0]
+        del self._owned[i]
+        self._owned[:0] = [True]
+    
+    def flash_row(self, r):
+        self._own(r)
+        row = self.array[r]
+        for x,b in enumerate(row):
+            if b:
+                row[x] = Block(b)
+                row[x].flash()
     
     def obstruction_at(self, coord):
         cx, cy = coord
         if not (isinstance(cx, int) and isinstance(cy, int)):
             raise KeyError("invalid index ({})".format(coord))
-        return self.array[cy][cx] is not None
+        return bool(self.masks[cy] >> cx & 1)
+    
+    def row_mask(self, y):
+        return self.masks[y]
+    
+    def collides(self, masks, x, y):
+        w, h = self.size
+        if x < 0 or y < 0 or y+len(masks) > h:
+            return True
+        rows = self.masks
+        for i,m in enumerate(masks):
+            m <<= x
+            if m >> w or rows[y+i] & m:
+                return True
+        return False
+    
+    def full_rows(self, rows=None):
+        full, masks = self.full, self.masks
+        if rows is None:
+            return [r for r,m in enumerate(masks) if m == full]
+        return [r for r in rows if masks[r] == full]
     
     def __iter__(self):
         for a in range(self.size[1]):
@@ -187,6 +385,34 @@ class BlockArray:
                 if self.array[a][b]:
                     yield self[b,a]
     
+    def cells(self):
+        for y,row in enumerate(self.array):
+            if self.masks[y]:
+                for x,b in enumerate(row):
+                    if b:
+                        yield x, y, b
+    
+    def fill(self, blocks):
+        """
+        fill(self, blocks)
+            Puts in every block of an iterable of ((x,y), block) pairs like
+            __setitem__, but hashes the board once at the end.
+        """
+        array, owned = self.array, self._owned
+        for (x,y), b in blocks:
+            if not owned[y]:
+                self._own(y)
+            array[y][x] = b
+            self._fill_mark(x, y)
+        self.zobrist = zobrist.board_hash(self.rowhash)
+    
+    def _fill_mark(self, x, y):
+        # _occupy without the board hash, which 'fill' computes at the end.
+        bit = 1 << x
+        if not self.masks[y] & bit:
+            self.masks[y] |= bit
+            self.rowhash[y] ^= zobrist.column_key(x)
+    
     def with_rects(self, ref):
         for a in range(self.size[1]):
             for b in range(self.size[0]):
@@ -195,4 +421,344 @@ class BlockArray:
     
     @property
     def dims(self):
-        return self.size
\ No newline at end of file
+        return self.size
+
+class PaletteBlockArray(BlockArray):
+    """
+    PaletteBlockArray - a BlockArray backed by NumPy rows instead of
+      Block objects.
+      
+      Every cell is a uint16: 0 if empty, otherwise the index of its color
+      in 'palette' plus one, with the SHADE and FLASH bits for the block's
+      state. Each row is an array of its own; 'grid' stacks them for whole
+      board operations (expansion, palette rebuilds, iteration). Blocks
+      handed out by __getitem__ and the iterators are fresh views -
+      changing them does not change the array (use 'flash_row' for that).
+      
+      When the palette runs out of indices, it is rebuilt from the colors
+      still on the grid.
+      
+      Snapshots share the rows like those of BlockArray: a row is copied
+      on its first write after a snapshot or restore.
+    """
+    SHADE = 0x4000
+    FLASH = 0x8000
+    INDEX = 0x3fff
+    
+    def __init__(self, size, rect):
+        self.size = tuple(size)[0:2]
+        self.rows = [np.zeros(self.size[0], np.uint16) for y in range(self.size[1])]
+        self._owned = [True]*self.size[1]
+        self.palette = []
+        self._index = {}
+        self.masks = [0]*size[1]
+        self.full  = (1 << size[0]) - 1
+        self.rowhash = [0]*size[1]
+        self.zobrist = 0
+    
+    @property
+    def grid(self):
+        return np.stack(self.rows)
+    
+    def _set_grid(self, grid):
+        self.rows = list(grid)
+        self._owned = [True]*len(self.rows)
+    
+    def _own(self, y):
+        if not self._owned[y]:
+            self.rows[y] = self.rows[y].copy()
+            self._owned[y] = True
+    
+    def snapshot(self):
+        self._owned = [False]*self.size[1]
+        return (self.size, tuple(self.rows), tuple(self.masks), tuple(self.palette),
+                tuple(self.rowhash), self.zobrist)
+    
+    def restore(self, snapshot):
+        size, rows, masks, palette, rowhash, z = snapshot
+        self.rowhash = list(rowhash)
+        self.zobrist = z
+        self.size  = size
+        self.rows  = list(rows)
+        self._owned = [False]*size[1]
+        self.masks = list(masks)
+        self.full  = (1 << size[0]) - 1
+        self.palette = list(palette)
+        self._index  = {tuple(c): i for i,c in enumerate(self.palette)}
+    
+    def _color_index(self, col):
+        key = tuple(col)
+        if key not in self._index:
+            if len(self.palette) == self.INDEX:
+                self._compact()
+                if len(self.palette) == self.INDEX:
+                    raise OverflowError("too many colors on the stage")
+            self._index[key] = len(self.palette)
+            self.palette.append(pygame.Color(*key))
+        return self._index[key]
+    
+    def _compact(self):
+        grid = self.grid
+        used = np.unique(grid & self.INDEX)
+        used = used[used != 0]
+        remap = np.zeros(self.INDEX+1, np.uint16)
+        remap[used] = np.arange(1, len(used)+1, dtype=np.uint16)
+        self._set_grid((grid & ~np.uint16(self.INDEX)) | remap[grid & self.INDEX])
+        self.palette = [self.palette[i-1] for i in used]
+        self._index = {tuple(c): i for i,c in enumerate(self.palette)}
+    
+    def _block(self, v):
+        if not v:
+            return None
+        b = Block(self.palette[(v & self.INDEX) - 1])
+        b.shaded   = bool(v & self.SHADE)
+        b.flashing = bool(v & self.FLASH)
+        return b
+    
+    def _update_masks(self):
+        occ = np.packbits(self.grid != 0, axis=1, bitorder="little")
+        for r in range(self.size[1]):
+            self.masks[r] = int.from_bytes(occ[r].tobytes(), "little")
+    
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and len(key) == 2 and \
+           all(isinstance(x,int) for x in key):
+            return self._block(int(self.rows[key[1]][key[0]]))
+        elif isinstance(key, int):
+            return [self._block(int(v)) for v in self.rows[key]]
+        raise KeyError("invalid index ({})".format(key))
+    
+    def __setitem__(self, key, val):
+        if not isinstance(val, Block):
+            val = Block(val)
+        if isinstance(key, tuple) and len(key) == 2 and \
+           all(isinstance(x,int) for x in key):
+            v = self._color_index(val.col) + 1
+            if val.shaded:
+                v |= self.SHADE
+            if val.flashing:
+                v |= self.FLASH
+            x,y = key
+            self._own(y)
+            self.rows[y][x] = v
+            self._occupy(x, y)
+        else:
+            raise KeyError("invalid index ({})".format(key))
+    
+    def expand(self, by):
+        try:
+            byx, byy = by
+            assert(isinstance(byx, int) and isinstance(byy, int))
+            assert(by[0]>0 and by[1]>0)
+        except:
+            raise ValueError("cannot expand BlockArray by " +
+                             "{} (use a pair of positive integers)".format(by))
+        grid = np.pad(np.pad(self.grid, ((0,0), (byx,byx)), "wrap"),
+                      ((byy,0), (0,0)), "constant")
+        self._set_grid(grid)
+        self.size = grid.shape[::-1]
+        self.full = (1 << self.size[0]) - 1
+        self.masks = [0]*self.size[1]
+        self._update_masks()
+        self._rehash()
+    
+    def delete_row(self, i):
+        self._delete_hash(i)
+        del self.rows[i]
+        self.rows[:0] = [np.zeros(self.size[0], np.uint16)]
+        del self._owned[i]
+        self._owned[:0] = [True]
+        del self.masks[i]
+        self.masks[:0] = [0]
+    
+    def flash_row(self, r):
+        self._own(r)
+        row = self.rows[r]
+        row[row != 0] ^= self.FLASH
+    
+    def __iter__(self):
+        grid = self.grid
+        for y,x in zip(*np.nonzero(grid)):
+            yield self._block(int(grid[y,x]))
+    
+    def cells(self):
+        grid = self.grid
+        for y,x in zip(*np.nonzero(grid)):
+            yield int(x), int(y), self._block(int(grid[y,x]))
+    
+    def fill(self, blocks):
+        for (x,y), b in blocks:
+            v = self._color_index(b.col) + 1
+            self._own(y)
+            self.rows[y][x] = v | (self.SHADE if b.shaded else 0) | \
+                                  (self.FLASH if b.flashing else 0)
+            self._fill_mark(x, y)
+        self.zobrist = zobrist.board_hash(self.rowhash)
+    
+    def with_rects(self, ref):
+        grid = self.grid
+        for y,x in zip(*np.nonzero(grid)):
+            yield self._block(int(grid[y,x])), \
+                  self.coords2rect(ref, (int(x),int(y)))
+
+class ChunkedBlockArray(BlockArray):
+    """
+    ChunkedBlockArray - a sparse BlockArray for very large stages.
+    
+      Rows are split into chunks of CHUNK cells, and a chunk is allocated
+      only once a block lands in it. Rows are referred to through a list of
+      row ids, so deleting a row drops its chunks and renumbers nothing.
+      Memory, 'expand' and the iterators cost O(number of blocks) (plus the
+      row masks of BlockArray) instead of O(area).
+      
+      Snapshots share the chunks; a row's chunks are copied on its first
+      write after a snapshot or restore.
+    """
+    CHUNK = 16
+    
+    def __init__(self, size, rect):
+        self.size = tuple(size)[0:2]
+        self._ids = itertools.count()
+        self.rows = [next(self._ids) for y in range(size[1])]
+        self.chunks = {}
+        self.masks = [0]*size[1]
+        self.full  = (1 << size[0]) - 1
+        self.rowhash = [0]*size[1]
+        self.zobrist = 0
+        self._owned = set()
+    
+    def _own(self, y):
+        rid = self.rows[y]
+        if rid not in self._owned:
+            row = self.chunks.get(rid, {})
+            self.chunks[rid] = {cx: c.copy() for cx,c in row.items()}
+            self._owned.add(rid)
+        return self.chunks[rid]
+    
+    def snapshot(self):
+        self._owned = set()
+        return (self.size, tuple(self.rows), dict(self.chunks), tuple(self.masks),
+                tuple(self.rowhash), self.zobrist)
+    
+    def restore(self, snapshot):
+        size, rows, chunks, masks, rowhash, z = snapshot
+        self.rowhash = list(rowhash)
+        self.zobrist = z
+        self.size   = size
+        self.rows   = list(rows)
+        self.chunks = dict(chunks)
+        self.masks  = list(masks)
+        self.full   = (1 << size[0]) - 1
+        self._owned = set()
+    
+    def _get(self, x, y):
+        chunk = self.chunks.get(self.rows[y], {}).get(x // self.CHUNK)
+        return chunk[x % self.CHUNK] if chunk else None
+    
+    def _set(self, x, y, val):
+        row = self._own(y)
+        cx, i = divmod(x, self.CHUNK)
+        if cx not in row:
+            row[cx] = [None]*self.CHUNK
+        row[cx][i] = val
+    
+    def _row_items(self, y):
+        # (x, block) pairs of row y, left to right.
+        row = self.chunks.get(self.rows[y], {})
+        for cx in sorted(row):
+            for i,b in enumerate(row[cx]):
+                if b:
+                    yield cx*self.CHUNK+i, b
+    
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and len(key) == 2 and \
+           all(isinstance(x,int) for x in key):
+            x, y = key
+            if not (0 <= x < self.size[0] and -self.size[1] <= y < self.size[1]):
+                raise IndexError("index ({}) out of range".format(key))
+            return self._get(x, y)
+        elif isinstance(key, int):
+            row = [None]*self.size[0]
+            for x,b in self._row_items(key):
+                row[x] = b
+            return row
+        raise KeyError("invalid index ({})".format(key))
+    
+    def __setitem__(self, key, val):
+        if not isinstance(val, Block):
+            val = Block(val)
+        if isinstance(key, tuple) and len(key) == 2 and \
+           all(isinstance(x,int) for x in key):
+            x, y = key
+            if not (0 <= x < self.size[0] and 0 <= y < self.size[1]):
+                raise IndexError("index ({}) out of range".format(key))
+            self._set(x, y, val)
+            self._occupy(x, y)
+        else:
+            raise KeyError("invalid index ({})".format(key))
+    
+    def expand(self, by):
+        try:
+            byx, byy = by
+            assert(isinstance(byx, int) and isinstance(byy, int))
+            assert(by[0]>0 and by[1]>0)
+        except:
+            raise ValueError("cannot expand BlockArray by " +
+                             "{} (use a pair of positive integers)".format(by))
+        sx, sy = self.size
+        width = sx+2*byx
+        old, self.chunks = self.chunks, {}
+        self._owned = set()
+        for y in range(sy):
+            items = []
+            row = old.get(self.rows[y], {})
+            for cx in sorted(row):
+                for i,b in enumerate(row[cx]):
+                    if b:
+                        items.append((cx*self.CHUNK+i, b))
+            for x,b in items:
+                # Copies of column x sit at byx+x + k*sx for every k that
+                # keeps them on the new stage.
+                for nx in range((byx+x) % sx, width, sx):
+                    self._set(nx, y, Block(b))
+        self.rows[:0] = [next(self._ids) for y in range(byy)]
+        self.size = (width, sy+byy)
+        self.full = (1 << width) - 1
+        self.masks = [0]*byy + [self._tile(m, sx, byx) for m in self.masks]
+        self._rehash()
+    
+    def delete_row(self, i):
+        self._delete_hash(i)
+        self.chunks.pop(self.rows[i], None)
+        del self.rows[i]
+        self.rows[:0] = [next(self._ids)]
+        del self.masks[i]
+        self.masks[:0] = [0]
+    
+    def flash_row(self, r):
+        for chunk in self._own(r).values():
+            for i,b in enumerate(chunk):
+                if b:
+                    chunk[i] = Block(b)
+                    chunk[i].flash()
+    
+    def __iter__(self):
+        for y in range(self.size[1]):
+            for x,b in self._row_items(y):
+                yield b
+    
+    def cells(self):
+        for y in range(self.size[1]):
+            for x,b in self._row_items(y):
+                yield x, y, b
+    
+    def fill(self, blocks):
+        for (x,y), b in blocks:
+            self._set(x, y, b)
+            self._fill_mark(x, y)
+        self.zobrist = zobrist.board_hash(self.rowhash)
+    
+    def with_rects(self, ref):
+        for y in range(self.size[1]):
+            for x,b in self._row_items(y):
+                yield b, self.coords2rect(ref, (x,y))
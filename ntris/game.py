@@ -29,12 +29,14 @@ import ntris.nminoctl
 import ntris.nminoprev
 import ntris.utils
 import ntris.position
+import ntris.session
 import ntris.ui
 from ntris.utils import noop, not_implemented
 
 from enum import Enum
 from os.path import expanduser, isfile
 import re
+import struct
 
 class Game:
 
@@ -46,7 +48,7 @@ class Game:
         
     def tick(self, dt):
         self.update(dt)
-        self.draw(self.screen)
+        return self.draw(self.screen)
     
     update = not_implemented
     draw   = not_implemented
@@ -108,6 +110,9 @@ class nTrisMsg(Enum):
     RIGHT         = 15,
     LEFT          = 16,
     DEBUG         = 17,
+    P1_DROP       = 18,
+    P2_DROP       = 19,
+    RESUME        = 20,
     
 class nTrisBase(Game):
     def __init__(self, screen):
@@ -130,6 +135,8 @@ class nTrisBase(Game):
         self.msgmap[nTrisMsg.P2_MOVE_DOWN]  = lambda dn : self.move(1, dn, ntris.position.Dir.DOWN)
         self.msgmap[nTrisMsg.P2_ROT_CW]     = lambda dn : self.rot(1, dn, ntris.position.Spin.CLOCKWISE)
         self.msgmap[nTrisMsg.P2_ROT_CCW]    = lambda dn : self.rot(1, dn, ntris.position.Spin.COUNTERCLOCKWISE)
+        self.msgmap[nTrisMsg.P1_DROP]       = lambda dn : self.drop(0, dn)
+        self.msgmap[nTrisMsg.P2_DROP]       = lambda dn : self.drop(1, dn)
         self.msgmap[nTrisMsg.PAUSE]  = lambda dn : self.pause(dn)
         self.msgmap[nTrisMsg.QUIT]   = lambda dn : self.quit(dn)
         self.msgmap[nTrisMsg.ACCEPT] = lambda dn : self.ok(dn)
@@ -138,6 +145,7 @@ class nTrisBase(Game):
         self.msgmap[nTrisMsg.RIGHT]  = lambda dn : self.select(dn,ntris.position.Dir.RIGHT)
         self.msgmap[nTrisMsg.LEFT]   = lambda dn : self.select(dn,ntris.position.Dir.LEFT)
         self.msgmap[nTrisMsg.DEBUG]  = lambda dn : self.debug(dn)
+        self.msgmap[nTrisMsg.RESUME] = lambda dn : self.resume(dn)
     
     def init_game_keymap(self):
         self.game_keymap = dict()
@@ -146,11 +154,13 @@ class nTrisBase(Game):
         self.game_keymap[K_s]      = nTrisMsg.P1_MOVE_DOWN
         self.game_keymap[K_v]      = nTrisMsg.P1_ROT_CCW
         self.game_keymap[K_b]      = nTrisMsg.P1_ROT_CW
+        self.game_keymap[K_w]      = nTrisMsg.P1_DROP
         self.game_keymap[K_LEFT]   = nTrisMsg.P2_MOVE_LEFT
         self.game_keymap[K_RIGHT]  = nTrisMsg.P2_MOVE_RIGHT
         self.game_keymap[K_DOWN]   = nTrisMsg.P2_MOVE_DOWN
         self.game_keymap[K_PERIOD] = nTrisMsg.P2_ROT_CCW
         self.game_keymap[K_SLASH]  = nTrisMsg.P2_ROT_CW
+        self.game_keymap[K_UP]     = nTrisMsg.P2_DROP
         self.game_keymap[K_p]      = nTrisMsg.PAUSE
         self.game_keymap[K_ESCAPE] = nTrisMsg.QUIT
         self.game_keymap[K_MINUS]  = nTrisMsg.DEBUG
@@ -163,6 +173,7 @@ class nTrisBase(Game):
         self.menu_keymap[K_UP]     = nTrisMsg.UP
         self.menu_keymap[K_ESCAPE] = nTrisMsg.QUIT
         self.menu_keymap[K_RETURN] = nTrisMsg.ACCEPT
+        self.menu_keymap[K_r]      = nTrisMsg.RESUME
     
     def switch_keymap_game(self):
         self.keymap = self.game_keymap
@@ -177,7 +188,9 @@ class nTrisBase(Game):
     select = noop
     move   = noop
     rot    = noop
+    drop   = noop
     debug  = noop
+    resume = noop
     
     def draw(self, screen):
         screen.blit(self.bg, (0,0))
@@ -247,6 +260,11 @@ class nTris(nTrisBase):
                 return self.nmc.rotate(spin)
             return None
         
+        def drop(self):
+            if self.nmc:
+                self.nmc.hard_drop()
+                self._move_dn()
+        
         def take_nmino(self, nmc):
             self.nmc = nmc
             self.downtimer.reset()
@@ -293,8 +311,9 @@ class nTris(nTrisBase):
         UI_SCORE_YOFFSET = 15
         UI_PTS_OFFSET = 10
         UI_OFFSTAGE_OFFSET = 15
+        UI_LOOKAHEAD = 3
         
-        def __init__(self, game):
+        def __init__(self, game, ncomps=4):
             self.game = game
             self.game.switch_keymap_game()
             
@@ -303,12 +322,15 @@ class nTris(nTrisBase):
             self.player = nTris.nTrisPlayerCtl(self.DEF_FREQ, self.placed)
             self.players = [self.player]
             
-            self.nmg = ntris.nmino.nMinoGen(4)
+            self.nmg = ntris.nmino.nMinoGen(ncomps)
             self.nmp = ntris.nminoprev.nMinoPrev(
                 ((self.STAGE_XOFFSET + self.STAGE_WIDTH + 40,
                     self.STAGE_TOP + 30),
                 (100,100)),
-                self.nmg)
+                self.nmg,
+                lookahead = self.UI_LOOKAHEAD,
+                stage = self.stage)
+            self.clearing = []
             self.feed_nmino(self.player)
             
             self.lvl = 1
@@ -370,31 +392,76 @@ class nTris(nTrisBase):
                         else:
                             self.game.sounds["blocked"].play()
         
+        def drop(self, player, keydown):
+            if keydown and player < len(self.players):
+                self.players[player].drop()
+        
         def pause(self, dn):
             if dn:
                 self.game.state = self.game.PausedState(self.game, self)
         
         def update(self, dt):
             self.stage.update(dt)
+            self.nmp.update(dt)
             for p in self.players:
                 p.update(dt)
             self.text_timerset.tick(dt)
             self.text_ntris.tick(dt)
         
         def draw(self, screen):
-            self.stage.draw(screen)
+            self._draw_stage(screen)
             self.nmp.draw(screen)
+            for txt in self._texts():
+                txt.draw(screen)
+            self._drawn = self._frame()
+        
+        def draw_dirty(self, screen):
+            pieces, queue, looks, rects = self._drawn
+            frame = self._frame()
+            cleared = rects + frame[3] if frame[2] != looks else []
+            stage_rect, nmp_rect = self.stage.full_rect, self.nmp.full_rect
+            stage = self.stage.needs_redraw or frame[0] != pieces or \
+                    stage_rect.collidelist(cleared) >= 0
+            nmp = frame[1] != queue or nmp_rect.collidelist(cleared) >= 0
+            if stage:
+                cleared.append(stage_rect)
+            if nmp:
+                cleared.append(nmp_rect)
+            if not cleared:
+                return []
+            for rect in cleared:
+                screen.blit(self.game.bg, rect, rect)
+            if stage:
+                self._draw_stage(screen)
+            if nmp:
+                self.nmp.draw(screen)
+            for txt in self._texts():
+                if txt.dirty_rect.collidelist(cleared) >= 0:
+                    txt.draw(screen)
+            self._drawn = frame
+            return cleared
+        
+        def _draw_stage(self, screen):
+            self.stage.draw(screen)
             for p in self.players:
                 if p.nmc:
+                    p.nmc.draw_ghost(screen)
                     p.nmc.draw(screen)
-            
-            self.text_ilvl.draw(screen)
-            self.text_vlvl.draw(screen)
-            self.text_vpts.draw(screen)
-            self.text_ipts.draw(screen)
-            self.text_ntris.draw(screen)
-            for txt in self.text_timerset:
-                txt.draw(screen)
+        
+        def _texts(self):
+            return [self.text_ilvl, self.text_vlvl, self.text_vpts,
+                    self.text_ipts, self.text_ntris] + list(self.text_timerset)
+        
+        def _frame(self):
+            # What the last draw showed: the falling pieces, the previewed
+            # pieces, the looks of the texts and where the texts were.
+            pieces = tuple((p.nmc.nmino, p.nmc.state, p.nmc.pos) if p.nmc
+                           else None for p in self.players)
+            queue = tuple(nmino for nmino, size in self.nmp.queue)
+            texts = self._texts()
+            return (pieces, queue[:self.nmp.lookahead],
+                    [txt.appearance() for txt in texts],
+                    [txt.dirty_rect for txt in texts])
             
         def set_name(self, flash=False):
             full_width = self.text_vpts.rect.left+self.text_vlvl.rect.right
@@ -410,35 +477,50 @@ class nTris(nTrisBase):
         
         def placed(self, player, loc, color):
             rows = {y for x,y in loc}
-            
-            rows_min = max(rows) + 0.5
-            t        = rows_min/self.stage.gridsize[1] #[0,1)
-            rect     = self.stage.rect
-            y        = int(t*rect.bottom + (1-t)*rect.top)
-            textpos  = (self.stage.rect.right + self.UI_OFFSTAGE_OFFSET, y)
-            
-            def proc(pts, col, time):
-                player.grant_points(pts)
-                self.text_vpts.score = self.player.score
-                if player.score >= self.threshold:
-                    self.lvlup()
-                self.feed_nmino(player)
-                text    = ntris.ui.Text(str(pts), textpos,
-                              color = col,
-                              ref = ntris.position.Ref.MIDLEFT)
-                self.text_timerset.add(text, time)
-            
+            textpos = self._textpos(rows)
             full = self.stage.get_full_rows(rows)
             if full:
-                pts = self.PTS_ROW*len(full)
                 self.game.sounds["line"].play()
-                self.stage.anim_delete(full, done = lambda: proc(pts, color, 1000))
+                self.delete_rows(player, full, color, textpos)
             else:
-                pts = self.PTS_PLACE
-                col = [255,255,255]
-                proc(pts, col, 500)
+                self._award(player, self.PTS_PLACE, [255,255,255], 500, textpos)
                 self.game.sounds["crash"].play()
         
+        def delete_rows(self, player, rows, color, textpos=None):
+            """
+            delete_rows(self, player, rows, color, textpos=None)
+                Animates 'rows' away, then grants 'player' the points for
+                them and hands them the next piece. Rows being deleted are
+                listed in 'clearing' as [rows, player, color] until then.
+            """
+            if textpos is None:
+                textpos = self._textpos(rows)
+            pts = self.PTS_ROW*len(rows)
+            entry = [rows, player, color]
+            self.clearing.append(entry)
+            def done():
+                self.clearing.remove(entry)
+                self._award(player, pts, color, 1000, textpos)
+            self.stage.anim_delete(rows, done = done)
+        
+        def _textpos(self, rows):
+            rows_min = max(rows) + 0.5
+            t        = rows_min/self.stage.gridsize[1] #[0,1)
+            rect     = self.stage.rect
+            y        = int(t*rect.bottom + (1-t)*rect.top)
+            return (self.stage.rect.right + self.UI_OFFSTAGE_OFFSET, y)
+        
+        def _award(self, player, pts, col, time, textpos):
+            player.grant_points(pts)
+            self.text_vpts.score = self.player.score
+            if player.score >= self.threshold:
+                self.lvlup()
+            self.feed_nmino(player)
+            text    = ntris.ui.Text(str(pts), textpos,
+                          color = col,
+                          ref = ntris.position.Ref.MIDLEFT)
+            self.text_timerset.add(text, time)
+        
         def feed_nmino(self, player):
             nm = self.nmp.get()
             try:
@@ -463,6 +545,7 @@ class nTris(nTrisBase):
             
             if not r:
                 self.stage.expand(1)
+                self.nmp.prewarm()
                 self.nmg.lvlup()
                 self.set_name(True)
             self.game.sounds["shake"].play()
@@ -499,6 +582,16 @@ class nTris(nTrisBase):
         def draw(self, screen):
             screen.blit(self.prevscreen, (0,0))
             self.text.draw(screen)
+            self._flashing = self.text.flashing
+        
+        def draw_dirty(self, screen):
+            if self.text.flashing == self._flashing:
+                return []
+            rect = self.text.dirty_rect
+            screen.blit(self.prevscreen, rect, rect)
+            self.text.draw(screen)
+            self._flashing = self.text.flashing
+            return [rect]
         
         def pause(self, dn):
             if dn:
@@ -663,19 +756,38 @@ class nTris(nTrisBase):
                 q = self.anim_t/self.anim_darken
                 col = [int(255*(1-q) + 64*q) for i in range(3)]
                 self.screen.fill(col, None, BLEND_RGB_MULT)
-                surface.blit(self.screen, (0,0))
-            elif self.anim_phase == 1:
-                surface.blit(self.screen, (0,0))
-            elif self.anim_phase >= 2:
-                surface.blit(self.screen, (0,0))
-                self.text_gameover.draw(surface)
+            surface.blit(self.screen, (0,0))
+            for text in self._texts():
+                text.draw(surface)
+            self._drawn = (self.anim_phase, self.anim_p,
+                           [u.flashing for u in self.upd_list])
+        
+        def draw_dirty(self, surface):
+            # Only the flashing texts change between the animation phases.
+            phase, p, flashing = self._drawn
+            if self.anim_phase == 0 or (self.anim_phase, self.anim_p) != (phase, p):
+                return None
+            rects = [u.dirty_rect for u,f in zip(self.upd_list, flashing)
+                     if u.flashing != f]
+            if rects:
+                for rect in rects:
+                    surface.blit(self.screen, rect, rect)
+                for text in self._texts():
+                    if text.dirty_rect.collidelist(rects) >= 0:
+                        text.draw(surface)
+                self._drawn = (phase, p, [u.flashing for u in self.upd_list])
+            return rects
+        
+        def _texts(self):
+            texts = []
+            if self.anim_phase >= 2:
+                texts.append(self.text_gameover)
             if self.anim_phase >= 3:
                 for p in range(self.anim_p):
-                    for text in self.text_scores[p]:
-                        text.draw(surface)
+                    texts.extend(self.text_scores[p])
             if self.anim_phase == 5:
-                self.text_esc.draw(surface)
-                self.text_enter.draw(surface)
+                texts.extend([self.text_esc, self.text_enter])
+            return texts
         
         def ok(self, dn):
             self.game.state = self.game.GameState(self.game)
@@ -698,21 +810,46 @@ class nTris(nTrisBase):
                 shade = True,
                 ref   = ntris.position.Ref.MIDCENTER
             )
+            self.text3 = None
+            if ntris.session.exists():
+                self.text3 = ntris.ui.Text("or R to resume the last game",
+                    self.text2.rect.move(0,5).midbottom,
+                    scale = (2,2),
+                    shade = True,
+                    ref   = ntris.position.Ref.TOPCENTER
+                )
         
         def draw(self, surface):
             self.text.draw(surface)
             self.text2.draw(surface)
+            if self.text3:
+                self.text3.draw(surface)
+            self._drawn = self.text3
+        
+        def draw_dirty(self, surface):
+            return [] if self.text3 is self._drawn else None
         
         def update(self, dt):
             pass
         
         def ok(self, dn):
             self.game.state = self.game.GameState(self.game)
+        
+        def resume(self, dn):
+            if dn and self.text3:
+                try:
+                    gs = ntris.session.load(self.game)
+                except (OSError, ValueError, struct.error):
+                    self.text3 = None
+                    return
+                self.game.state = self.game.PausedState(self.game, gs)
     
     
     # nTris
-    def __init__(self, screen):
+    def __init__(self, screen, dirty_rects=False):
         super().__init__(screen)
+        self.dirty_rects = dirty_rects
+        self._drawn = None
         self.init_sounds()
         self.state = self.MenuState(self)
         self.hiscore = 5000
@@ -764,11 +901,30 @@ class nTris(nTrisBase):
             f.write("hiscore = "+str(self.hiscore)+"\n")
     
     def draw(self, screen):
+        """
+        draw(self, screen)
+            Returns the list of rects of 'screen' that changed, or None if
+            the whole screen was redrawn. Unless 'dirty_rects' is set, and
+            whenever the state changes, the whole screen is redrawn. Every
+            state has a 'draw_dirty', which redraws what changed since its
+            last draw and returns the rects, or None for a full redraw.
+        """
+        if self.dirty_rects and self.state is self._drawn:
+            rects = self.state.draw_dirty(screen)
+            if rects is not None:
+                return rects
         screen.blit(self.bg, (0,0))
         self.state.draw(screen)
+        self._drawn = self.state
+        return None
         
     def finalize(self):
         self.save_settings()
+        state = self.state
+        if isinstance(state, self.PausedState):
+            state = state.gamestate
+        if isinstance(state, self.GameState):
+            ntris.session.save(state)
     
     delegate2state = {
         "update",
@@ -778,6 +934,8 @@ class nTris(nTrisBase):
         "quit",
         "select",
         "debug",
+        "drop",
+        "resume",
         "ok"
     }
     
@@ -30,6 +30,8 @@ from ntris.game import nTris
 SCR_WIDTH = 500
 SCR_HEIGHT = 540
 FPS = 60
+# Redraw and update only the parts of the screen that changed.
+DIRTY_RECTS = True
 
 def main():
     pygame.mixer.pre_init(44100)
@@ -38,7 +40,7 @@ def main():
     pygame.display.set_caption("ntris")
     
     clock  = pygame.time.Clock()
-    game   = nTris(screen)
+    game   = nTris(screen, DIRTY_RECTS)
     
     going = True
     while going:
@@ -48,8 +50,11 @@ def main():
                 going = False
             else:
                 game.event(event)
-        game.tick(dt)
-        pygame.display.flip()
+        rects = game.tick(dt)
+        if rects is None:
+            pygame.display.flip()
+        elif rects:
+            pygame.display.update(rects)
     game.finalize()
     pygame.quit()
 
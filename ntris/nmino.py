@@ -21,27 +21,84 @@
 # SOFTWARE.
 
 import ntris.blocks as blk
+import ntris.nminoenum as nminoenum
+import ntris.nminolib as nminolib
+import ntris.nminosample as nminosample
 import ntris.utils
+import ntris.zobrist as zobrist
 
 import pygame
+from pygame.locals import *
 import random
+from array import array
 
 class nMino:
+    """
+    nMino - an immutable piece: a set of cells normalized around their
+      barycenter, plus a color. Bounds, barycenter and the sorted cell
+      tuple are computed once at construction; copies share them.
+      
+      Drawn pieces are kept in nMino.SPRITES by cells, color and size, so
+      a piece is put together from its blocks once per rotation state and
+      size, and then drawn in one blit.
+      
+    Methods:
+      __init__(col)
+      __init__(col, cells)
+      __init__(nMino)
+      rotate(clockwise=True)
+      bounds()
+      draw(surface)
+      sprite(size) : the piece drawn into a per-pixel alpha surface
+    
+    Properties:
+      components : frozenset of (x,y)
+      cells      : sorted tuple of (x,y)
+      color      : tuple of ints
+      width, height
+    """
+    __slots__ = ("components", "cells", "color", "_bounds", "_fbarycenter",
+                 "rotations", "state")
+    SPRITES = blk.SpriteCache(128)
+    
     def __init__(self, *args):
         if isinstance(args[0], nMino):
-            self.components = args[0].components.copy()
-            self.color = pygame.Color(*args[0].color)
+            for name in nMino.__slots__:
+                object.__setattr__(self, name, getattr(args[0], name))
+            return
+        if len(args) == 2:
+            if not self.is_valid_set(args[1]):
+                raise TypeError("second argument is not a set of ints")
+            cells = args[1]
+        elif len(args) == 1:
+            cells = ()
+        else:
+            raise TypeError("expected 1 or 2 arguments, got {}".format(len(args)))
+        n = len(cells)
+        if n:
+            bx = int(round(sum(x for x,y in cells)/n))
+            by = int(round(sum(y for x,y in cells)/n))
+            cells = frozenset((x-bx, y-by) for x,y in cells)
         else:
-            if len(args) == 2:
-                if not self.is_valid_set(args[1]):
-                    raise TypeError("second argument is not a set of ints")
-                self.components = args[1]
-            elif len(args) == 1:
-                self.components = set()
-            else:
-                raise TypeError("expected 1 or 2 arguments, got {}".format(len(args)))
-            self.normalize()
-            self.color = pygame.Color(*args[0])
+            cells = frozenset()
+        init = object.__setattr__
+        init(self, "components", cells)
+        init(self, "cells", tuple(sorted(cells)))
+        init(self, "color", tuple(pygame.Color(*args[0])))
+        if n:
+            xs = [x for x,y in cells]
+            ys = [y for x,y in cells]
+            init(self, "_bounds", (min(xs), min(ys),
+                                   max(xs)-min(xs)+1, max(ys)-min(ys)+1))
+            init(self, "_fbarycenter", (sum(xs)/n, sum(ys)/n))
+        else:
+            init(self, "_bounds", (0,0,0,0))
+            init(self, "_fbarycenter", (0.0,0.0))
+        init(self, "rotations", None)
+        init(self, "state", 0)
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("nMino is immutable")
     
     def is_valid_set(self,s):
         for v in s:
@@ -52,45 +109,47 @@ class nMino:
         return True
     
     def rotate(self, clockwise=True):
-        bx,by = self.fbarycenter()
+        if self.rotations is not None:
+            return self.rotations[self.rotations.turn(self.state, clockwise)]
+        bx,by = self._fbarycenter
         eps = 1e-10
         if clockwise:
-            new = {(int(round(-y+by+eps)), int(round(x-bx+eps))) for x,y in self.components}
+            new = {(int(round(-y+by+eps)), int(round(x-bx+eps))) for x,y in self.cells}
         else:
-            new = {(int(round(y-by+eps)), int(round(-x+bx+eps))) for x,y in self.components}
+            new = {(int(round(y-by+eps)), int(round(-x+bx+eps))) for x,y in self.cells}
         return nMino(self.color, new)
     
-    def add(self, coord):
-        coord2 = tuple(coord)[0:2]
-        if not all(isinstance(x, int) for x in coord2):
-            raise ValueError("expected pair of ints, got {}".format(coord))
-        self.components.add(coord2)
+    def rotation_table(self):
+        if self.rotations is None:
+            Rotations(self)
+        return self.rotations
     
     def __iter__(self):
-        return iter(self.components)
+        return iter(self.cells)
+    
+    def __len__(self):
+        return len(self.cells)
         
     def fbarycenter(self):
-        cx = sum(v[0] for v in self.components)
-        cy = sum(v[1] for v in self.components)
-        n = len(self.components)
-        return (cx/n, cy/n) if n else (0.0,0.0)
+        return self._fbarycenter
     
     def barycenter(self):
-        bx, by = self.fbarycenter()
+        bx, by = self._fbarycenter
         return int(round(bx)), int(round(by))
 
-    def normalize(self):
-        bx, by = self.barycenter()
-        self.components = {(x-bx, y-by) for x,y in self.components}
+    def canonical(self, symmetry=nminoenum.Symmetry.ONE_SIDED):
+        return nminoenum.key(self.cells, symmetry)
     
     def bounds(self):
-        if not self.components:
-            return pygame.Rect(0,0,0,0)
-        mx = min(x for x,y in self.components)
-        Mx = max(x for x,y in self.components)
-        my = min(y for x,y in self.components)
-        My = max(y for x,y in self.components)
-        return pygame.Rect(mx,my,Mx-mx+1,My-my+1)
+        return pygame.Rect(self._bounds)
+    
+    @property
+    def width(self):
+        return self._bounds[2]
+    
+    @property
+    def height(self):
+        return self._bounds[3]
     
     def blocks(self, *args):
         bounds = self.bounds()
@@ -101,7 +160,7 @@ class nMino:
             rect.size = (bounds.width*size, bounds.height*size)
         else:
             rect = pygame.Rect(args[0])
-        for x,y in self.components:
+        for x,y in self.cells:
             blkrect = (rect.left + (x-bounds.left)*rect.width  // bounds.width,
                        rect.top  + (y-bounds.top) *rect.height // bounds.height,
                        rect.left + (x-bounds.left+1)*rect.width  // bounds.width,
@@ -111,8 +170,80 @@ class nMino:
             yield blk.Block(self.color), blkrect
     
     def draw(self, surface):
-        for block, rect in self.blocks(((0,0), surface.get_size())):
-            block.draw(surface.subsurface(rect))
+        surface.blit(self.sprite(surface.get_size()), (0,0))
+    
+    def sprite(self, size):
+        return nMino.SPRITES.get((self.cells, self.color, tuple(size)),
+                                 lambda: self._render(size))
+    
+    def _render(self, size):
+        # Block sprites are copied, not blended, so that blitting the piece
+        # gives the same pixels as blitting its blocks one by one.
+        surf = pygame.Surface(size, SRCALPHA)
+        for block, rect in self.blocks(((0,0), size)):
+            surf.blit(block.sprite(rect[2:]), rect, None, BLEND_RGBA_MAX)
+        return surf
+
+class Rotations:
+    """
+    Rotations - the distinct rotation states of an nMino, computed once.
+    
+      State k is the nMino rotated clockwise k times. The table is closed:
+      turning past the last state gives back state 0 exactly, so repeated
+      rotations cannot drift the piece through barycenter rounding. Each
+      state nMino gets 'rotations' and 'state' attributes pointing back
+      into the table.
+    
+    Attributes:
+      states : tuple of nMinos
+      order  : number of distinct states (1, 2 or 4)
+      bounds : tuple of the states' bounds
+      masks  : tuple of the states' row bitmasks; masks[k][i] has bit j set
+               if state k has the cell (bounds[k].left+j, bounds[k].top+i)
+      skirts : tuple of the states' bottom profiles; skirts[k][j] is the
+               lowest row of column bounds[k].left+j, relative to
+               bounds[k].top
+      key    : 64-bit hash of the shape, the same for all states (see
+               ntris.zobrist.piece_hash)
+    """
+    def __init__(self, nmino):
+        states = [nmino]
+        shape = nminoenum.normalized(nmino.components)
+        rot = nmino.rotate()
+        while len(states) < 4 and nminoenum.normalized(rot.components) != shape:
+            states.append(rot)
+            rot = rot.rotate()
+        for k, s in enumerate(states):
+            object.__setattr__(s, "rotations", self)
+            object.__setattr__(s, "state", k)
+        self.states = tuple(states)
+        self.order  = len(states)
+        self.bounds = tuple(s.bounds() for s in states)
+        self.masks  = tuple(self._row_masks(s, b)
+                            for s,b in zip(states, self.bounds))
+        self.skirts = tuple(self._skirt(s, b)
+                            for s,b in zip(states, self.bounds))
+        self.key    = zobrist.fold(nminoenum.key(nmino.components))
+    
+    @staticmethod
+    def _row_masks(nmino, bounds):
+        masks = [0]*bounds.height
+        for x,y in nmino:
+            masks[y-bounds.top] |= 1 << (x-bounds.left)
+        return tuple(masks)
+    
+    @staticmethod
+    def _skirt(nmino, bounds):
+        skirt = [0]*bounds.width
+        for x,y in nmino:
+            skirt[x-bounds.left] = max(skirt[x-bounds.left], y-bounds.top)
+        return tuple(skirt)
+    
+    def __getitem__(self, k):
+        return self.states[k % self.order]
+    
+    def turn(self, state, clockwise=True):
+        return (state + (1 if clockwise else -1)) % self.order
 
 names = {"1"   : "MONO",
          "2"   : "DI",
@@ -158,98 +289,127 @@ names = {"1"   : "MONO",
             
             
 class nMinoGen:
-    TOOCOMPLEX = 8
+    TOOCOMPLEX = 14
+    SYMMETRY = nminoenum.Symmetry.ONE_SIDED
+    PROCESSES = 1
     S,V = 100, 80
     
-    def __init__(self, n):
+    def __init__(self, n, background=True):
+        """
+        __init__(self, n, background=True)
+        __init__(self, nMinoGen)
+            With 'background' False, libraries are never built in a worker
+            process: the library is loaded (and built if need be) right
+            away, and the next size is not prefetched. Use it where child
+            processes aren't allowed, e.g. in multiprocessing pool workers.
+        """
         if isinstance(n, nMinoGen):
+            self.background = n.background
             self.ncomps = n.ncomps
-            self.patterns = n.patterns.copy()
-            self.colors = n.colors.copy()
+            self.patterns = n.patterns
+            self.colors = n.colors
+            self._index = n._index
+            self._rotations = n._rotations
         else:
+            self.background = background
             self.ncomps = n
-            if n < nMinoGen.TOOCOMPLEX:
+            self.patterns = None
+            self.colors = None
+            self._index = None
+            self._rotations = {}
+            # Only a library that is already cached is mapped here; any other
+            # gets built in the background while pieces are sampled.
+            if n < nMinoGen.TOOCOMPLEX and not background:
                 self.pregenerate()
+            elif n < nMinoGen.TOOCOMPLEX:
+                nminolib.prefetch(n, nMinoGen.SYMMETRY)
+                if nminolib.ready(n, nMinoGen.SYMMETRY):
+                    self.pregenerate()
+            self.prefetch()
         
     def generate(self):
-        if self.ncomps < nMinoGen.TOOCOMPLEX:
-            p = random.choice(tuple(self.patterns))
-            nm = nMino(self.colors[p], p)
-            n = random.randint(0,3)
-            for i in range(n):
-                nm = nm.rotate()
-            return nm
+        if self.patterns is None and self.ncomps < nMinoGen.TOOCOMPLEX and \
+           nminolib.ready(self.ncomps, nMinoGen.SYMMETRY):
+            self.pregenerate()
+        if self.patterns is not None:
+            return self.spawn(random.randrange(len(self.patterns)))
         else:
             return self.generate_inaccurate()
     
+    def spawn(self, i):
+        rots = self.rotations(i)
+        return rots[random.randrange(rots.order)]
+    
     def pregenerate(self):
-        begin = frozenset([(0,0)])
-        self.patterns = set([begin])
-        i, self.ncomps = self.ncomps, 1
-        while self.ncomps != i:
-            self.ncomps+= 1
-            self.postgenerate()
+        self.postgenerate()
         self.update_colors()
     
     def postgenerate(self):
-        translates = [lambda x,y: (x+1,y),
-                      lambda x,y: (x-1,y),
-                      lambda x,y: (x,y+1),
-                      lambda x,y: (x,y-1)]
-        new = set()
-        for p in self.patterns:
-            nmino = nMino([0,0,0], set(p))
-            for x,y in nmino:
-                for t in translates:
-                    nmino2 = nMino(nmino)
-                    tx,ty = t(x,y)
-                    if not (tx,ty) in nmino.components:
-                        nmino2.add((tx,ty))
-                        nmino2.normalize()
-                        allout = True
-                        for i in range(4):
-                            allout = allout and frozenset(nmino2.components) not in new
-                            nmino2 = nmino2.rotate()
-                        if allout:
-                            new.add(frozenset(nmino2.components))
-        self.patterns = new
+        self.patterns = nminolib.load(self.ncomps, nMinoGen.SYMMETRY,
+                                      nMinoGen.PROCESSES)
+        self._index = None
+        self._rotations = {}
+    
+    def rotations(self, i):
+        """
+        rotations(self, i)
+            Returns the Rotations table of pattern 'i', building it the first
+            time the pattern is used.
+        """
+        if i not in self._rotations:
+            self._rotations[i] = Rotations(nMino(self.color(i), self.patterns[i]))
+        return self._rotations[i]
+    
+    def pattern_id(self, nmino):
+        """
+        pattern_id(self, nmino)
+            Returns the index in 'patterns' of the library pattern 'nmino' is
+            a rotation of, or None if it isn't one.
+        """
+        if self.patterns is None or len(nmino.components) != self.ncomps:
+            return None
+        if self._index is None:
+            self._index = {self.patterns.mask(i) : i
+                           for i in range(len(self.patterns))}
+        return self._index.get(nmino.canonical(nMinoGen.SYMMETRY))
     
     def generate_inaccurate(self):
         h = random.random()*360
         c = pygame.Color(255,255,255,255)
         c.hsva = h, nMinoGen.S, nMinoGen.V, 100
-        m = nMino(c)
-        m.add((0,0))
-        d = []
-        s = set([(0,0)])
-        translates = [lambda x,y: (x,y+1),
-                      lambda x,y: (x-+1,y),
-                      lambda x,y: (x,y-1),
-                      lambda x,y: (x-1,y)]
-        cur = (0,0)
-        while len(m.components) < self.ncomps:
-            for t in translates:
-                tx,ty = t(cur[0],cur[1])
-                if (ty, tx) > (0,0) and (tx,ty) not in s:
-                    d.append((tx,ty))
-                    s.add((tx,ty))
-            i = random.choice(range(len(d)))
-            i = random.choice(range(i,len(d)))
-            cur = d[i]
-            m.add(cur)
-            del d[i]
-        m.normalize()
-        return m
+        return nMino(c, nminosample.sample(self.ncomps))
+    
+    def prefetch(self):
+        """
+        prefetch(self)
+            Starts building the library for the next size in a worker
+            process, unless it is already cached.
+        """
+        if self.background and self.ncomps+1 < nMinoGen.TOOCOMPLEX:
+            nminolib.prefetch(self.ncomps+1, nMinoGen.SYMMETRY)
     
     def lvlup(self):
+        """
+        lvlup(self)
+            Switches to pieces one cell larger. If the prefetched library is
+            not ready yet, pieces come from 'generate_inaccurate' until it
+            is; 'generate' swaps the library in as soon as the build ends.
+        """
         self.ncomps+= 1
-        if self.ncomps < nMinoGen.TOOCOMPLEX:
-            self.postgenerate()
-            self.update_colors()
+        self.patterns = None
+        if self.ncomps < nMinoGen.TOOCOMPLEX and \
+           nminolib.ready(self.ncomps, nMinoGen.SYMMETRY):
+            self.pregenerate()
+        self.prefetch()
     
     def update_colors(self):
-        self.colors = {p : ntris.utils.hsv(i, len(self.patterns), 100,100)
-            for i,p in enumerate(self.patterns)}
+        # Filled in lazily by 'color'; 0 is never a valid (opaque) color.
+        self.colors = array("I", bytes(4*len(self.patterns)))
+    
+    def color(self, i):
+        if not self.colors[i]:
+            self.colors[i] = int(ntris.utils.hsv(i, len(self.patterns), 100,100))
+        return pygame.Color(self.colors[i])
     
     def max_size(self):
         return self.ncomps
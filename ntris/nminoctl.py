@@ -20,22 +20,36 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import pygame
+from pygame.locals import *
+
 import ntris.stage as stg
 import ntris.nmino as nm
 import ntris.blocks as blk
+import ntris.zobrist as zobrist
 from ntris.position import Dir, Spin, Ref
 
 class GameOver(Exception):
     pass
     
 class nMinoCtl:
-    def __init__(self, nmino, stage):
+    GHOST_ALPHA = 60
+    # Faded pieces by (cells, color, size), like nMino.SPRITES.
+    GHOSTS = blk.SpriteCache(32)
+    
+    def __init__(self, nmino, stage, pos=None):
         if not (isinstance(nmino, nm.nMino) and isinstance(stage, stg.Stage)):
             raise ValueError("invalid arguments: first has to be an nMino, " +
               "while second a Stage")
         self.nmino = nmino
+        self.rotations = nmino.rotation_table()
+        self.state = nmino.state
         self.stage = stage
-        if not self.set_pos(Ref.TOPCENTER, (stage.gridsize[0]//2, stage.gridsize[1]-1)):
+        self.active = False
+        if pos is not None:
+            if not self.set_pos(Ref.MIDCENTER, pos):
+                raise ValueError("position {} is blocked".format(pos))
+        elif not self.set_pos(Ref.TOPCENTER, (stage.gridsize[0]//2, stage.gridsize[1]-1)):
             raise GameOver
         
     def move(self, dir):
@@ -53,7 +67,7 @@ class nMinoCtl:
     def set_pos(self, ref, pos):
         if not isinstance(ref, Ref):
             raise ValueError("instance of Ref expected")
-        bounds = self.nmino.bounds()
+        bounds = self.rotations.bounds[self.state]
         if ref.value % 3 == 1: #left
             x = pos[0] - bounds.left
         elif ref.value % 3 == 2: #center
@@ -68,7 +82,9 @@ class nMinoCtl:
             y = pos[1] + bounds.top
         X,Y = x, self.stage.gridsize[1]-y-1
         if self.pos_allowed(X,Y):
+            self._lift()
             self.pos = (x,y)
+            self._place()
             return True
         else:
             return False
@@ -76,21 +92,67 @@ class nMinoCtl:
     def rotate(self, spin):
         if not isinstance(spin, Spin):
             raise ValueError("instance of Spin expected")
-        rot = self.nmino.rotate(spin == Spin.CLOCKWISE)
-        tmp, self.nmino = self.nmino, rot
-        if self.pos_allowed(*self.pos_stage):
+        state = self.rotations.turn(self.state, spin == Spin.CLOCKWISE)
+        if self.pos_allowed(*self.pos_stage, state=state):
+            self._lift()
+            self.nmino = self.rotations[state]
+            self.state = state
+            self._place()
             return True
         else:
-            self.nmino = tmp
             return False
         
-    def pos_allowed(self, x, y):
-        for px,py in self.nmino:
-            if self.stage.obstructs((px+x, py+y)):
-                return False
-        return True
+    def _lift(self):
+        # Takes the piece out of the stage's index of active pieces, so
+        # that it doesn't collide with itself.
+        if self.active:
+            bounds = self.rotations.bounds[self.state]
+            x,y = self.pos_stage
+            self.stage.remove_active(self.rotations.masks[self.state],
+                                     x+bounds.left, y+bounds.top)
+            self.active = False
+    
+    def _place(self):
+        if not self.active:
+            bounds = self.rotations.bounds[self.state]
+            x,y = self.pos_stage
+            self.stage.add_active(self.rotations.masks[self.state],
+                                  x+bounds.left, y+bounds.top)
+            self.active = True
+        
+    def pos_allowed(self, x, y, state=None):
+        if state is None:
+            state = self.state
+        bounds = self.rotations.bounds[state]
+        active = self.active
+        self._lift()
+        ret = not self.stage.collides(self.rotations.masks[state],
+                                      x+bounds.left, y+bounds.top)
+        if active:
+            self._place()
+        return ret
+    
+    def drop_distance(self):
+        bounds = self.rotations.bounds[self.state]
+        x,y = self.pos_stage
+        active = self.active
+        self._lift()
+        d = self.stage.drop_distance(self.rotations.masks[self.state],
+                                     self.rotations.skirts[self.state],
+                                     x+bounds.left, y+bounds.top)
+        if active:
+            self._place()
+        return d
+    
+    def hard_drop(self):
+        d = self.drop_distance()
+        self._lift()
+        self.pos = (self.pos[0], self.pos[1]-d)
+        self._place()
+        return d
     
     def rest(self):
+        self._lift()
         x,y = self.pos_stage
         ret = []
         for px,py in self.nmino:
@@ -99,14 +161,44 @@ class nMinoCtl:
         self.nmino = None
         return ret
     
-    def draw(self, surface):
-        bounds = self.nmino.bounds()
+    def snapshot(self):
+        return (self.nmino, self.rotations, self.state, self.pos, self.active)
+    
+    def restore(self, snapshot):
+        """
+        restore(self, snapshot)
+            Puts the piece back where it was. The stage's index of active
+            pieces is not touched, so restore the Stage from a snapshot taken
+            at the same time first.
+        """
+        self.nmino, self.rotations, self.state, self.pos, self.active = snapshot
+    
+    @property
+    def zobrist(self):
+        """
+        64-bit hash of the piece's shape, rotation and position. Combine
+        with Stage.zobrist by XOR to key a whole position.
+        """
+        return zobrist.piece_hash(self.rotations.key, self.state, *self.pos)
+    
+    def _rect(self, dy=0):
+        bounds = self.rotations.bounds[self.state]
         x,y = self.pos_stage
-        x += bounds.x
-        y += bounds.y
-        size = bounds.size
-        rect = self.stage.stage2screen((x,y), size)
-        self.nmino.draw(surface.subsurface(rect))
+        return self.stage.stage2screen((x+bounds.x, y+bounds.y+dy), bounds.size)
+    
+    def draw(self, surface):
+        self.nmino.draw(surface.subsurface(self._rect()))
+    
+    def draw_ghost(self, surface):
+        rect = self._rect(self.drop_distance())
+        key = (self.nmino.cells, self.nmino.color, rect.size)
+        surface.blit(nMinoCtl.GHOSTS.get(key, lambda: self._render_ghost(rect.size)), rect)
+    
+    def _render_ghost(self, size):
+        ghost = pygame.Surface(size, SRCALPHA)
+        self.nmino.draw(ghost)
+        ghost.fill((255,255,255,self.GHOST_ALPHA), None, BLEND_RGBA_MULT)
+        return ghost
         
     def __bool__(self):
         return bool(self.nmino)
@@ -0,0 +1,232 @@
+# MIT License
+#
+# Copyright (c) 2016 Marcin Zubilewicz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from enum import Enum
+import multiprocessing
+
+class Symmetry(Enum):
+    """
+    Symmetry - which transformations make two polyominoes "the same".
+
+      FIXED     : only translations,
+      ONE_SIDED : translations and rotations (what the game uses, since
+                  pieces cannot be flipped),
+      FREE      : translations, rotations and reflections.
+    """
+    FIXED     = 1
+    ONE_SIDED = 2
+    FREE      = 3
+
+# Depth at which the parallel search tree is cut into tasks; there are
+# COUNTS[Symmetry.FIXED][SPLIT_DEPTH] of them.
+SPLIT_DEPTH = 7
+
+# Number of polyominoes of size n (OEIS A001168, A000988, A000105).
+COUNTS = {
+    Symmetry.FIXED     : (1, 1, 2, 6, 19, 63, 216, 760, 2725, 9910, 36446,
+                          135268, 505861, 1903890, 7204874),
+    Symmetry.ONE_SIDED : (1, 1, 1, 2, 7, 18, 60, 196, 704, 2500, 9189,
+                          33896, 126759, 476270, 1802312),
+    Symmetry.FREE      : (1, 1, 1, 2, 5, 12, 35, 108, 369, 1285, 4655,
+                          17073, 63600, 238591, 901971)
+}
+
+_TRANSFORMS = {
+    Symmetry.FIXED     : (lambda x,y: ( x, y),),
+    Symmetry.ONE_SIDED : (lambda x,y: ( x, y),
+                          lambda x,y: (-y, x),
+                          lambda x,y: (-x,-y),
+                          lambda x,y: ( y,-x)),
+    Symmetry.FREE      : (lambda x,y: ( x, y),
+                          lambda x,y: (-y, x),
+                          lambda x,y: (-x,-y),
+                          lambda x,y: ( y,-x),
+                          lambda x,y: (-x, y),
+                          lambda x,y: ( y, x),
+                          lambda x,y: ( x,-y),
+                          lambda x,y: (-y,-x))
+}
+
+def _shifted(cells):
+    mx = min(x for x,y in cells)
+    my = min(y for x,y in cells)
+    return [(x-mx, y-my) for x,y in cells]
+
+def normalized(cells):
+    """
+    normalized(cells)
+        Returns 'cells' translated so that the smallest coordinates are
+        zero, as a sorted tuple of pairs.
+    """
+    return tuple(sorted(_shifted(cells)))
+
+def encode(cells, n):
+    """
+    encode(cells, n)
+        Packs cells of an n-omino translated to the origin into an int;
+        cell (x,y) is bit y*n + x.
+    """
+    mask = 0
+    for x,y in cells:
+        mask |= 1 << (y*n + x)
+    return mask
+
+def decode(mask, n):
+    """
+    decode(mask, n)
+        Inverse of 'encode', returns a list of cells.
+    """
+    cells = []
+    while mask:
+        low = mask & -mask
+        y,x = divmod(low.bit_length()-1, n)
+        cells.append((x,y))
+        mask ^= low
+    return cells
+
+def key(cells, symmetry=Symmetry.ONE_SIDED):
+    """
+    key(cells, symmetry=Symmetry.ONE_SIDED)
+        Returns the canonical key of a polyomino: the smallest 'encode'd
+        form over the given symmetry group. Two polyominoes are equivalent
+        iff their keys are equal. Takes O(n) time.
+    """
+    n = len(cells)
+    return min(encode(_shifted([t(x,y) for x,y in cells]), n)
+               for t in _TRANSFORMS[symmetry])
+
+def canonical(cells, symmetry=Symmetry.ONE_SIDED):
+    """
+    canonical(cells, symmetry=Symmetry.ONE_SIDED)
+        Returns the orientation of 'cells' with the smallest key, normalized.
+    """
+    return normalized(decode(key(cells, symmetry), len(cells)))
+
+def _allowed(x, y):
+    # Redelmeier's half-plane: the origin is the lowest-leftmost cell.
+    return y > 0 or (y == 0 and x >= 0)
+
+def _grow(n, poly, seen, untried):
+    while untried:
+        cell = untried.pop()
+        poly.append(cell)
+        if len(poly) == n:
+            yield tuple(poly)
+        else:
+            x,y = cell
+            new = [c for c in ((x+1,y), (x-1,y), (x,y+1), (x,y-1))
+                   if c not in seen and _allowed(*c)]
+            seen.update(new)
+            yield from _grow(n, poly, seen, untried + new)
+            seen.difference_update(new)
+        poly.pop()
+
+def fixed(n):
+    """
+    fixed(n)
+        Yields every fixed polyomino of size 'n' exactly once, as a tuple of
+        (x,y) cells. Uses Redelmeier's algorithm, so memory stays O(n) no
+        matter how many polyominoes there are.
+    """
+    if n < 1:
+        return
+    yield from _grow(n, [], {(0,0)}, [(0,0)])
+
+def _prefixes(depth, poly, seen, untried):
+    # Same walk as '_grow', but stops at size 'depth' and yields the state
+    # needed to resume the search below that node.
+    while untried:
+        cell = untried.pop()
+        poly.append(cell)
+        x,y = cell
+        new = [c for c in ((x+1,y), (x-1,y), (x,y+1), (x,y-1))
+               if c not in seen and _allowed(*c)]
+        seen.update(new)
+        if len(poly) == depth:
+            yield tuple(poly), frozenset(seen), tuple(untried + new)
+        else:
+            yield from _prefixes(depth, poly, seen, untried + new)
+        seen.difference_update(new)
+        poly.pop()
+
+def _keep(p, transforms):
+    n = len(p)
+    k = encode(p, n)
+    return all(k <= encode(_shifted([t(x,y) for x,y in p]), n)
+               for t in transforms)
+
+def _subtree(args):
+    n, symmetry, poly, seen, untried = args
+    transforms = _TRANSFORMS[symmetry][1:]
+    ret = []
+    for p in _grow(n, list(poly), set(seen), list(untried)):
+        p = normalized(p)
+        if _keep(p, transforms):
+            ret.append(p)
+    return ret
+
+def polyominoes(n, symmetry=Symmetry.ONE_SIDED, processes=None):
+    """
+    polyominoes(n, symmetry=Symmetry.ONE_SIDED, processes=None)
+        Yields every polyomino of size 'n' exactly once up to 'symmetry',
+        each one in its canonical form (see 'canonical').
+
+        Every fixed polyomino is generated once, and only the one with the
+        smallest key in its class is passed on.
+
+        With 'processes' > 1 the search tree is cut at depth SPLIT_DEPTH
+        and the subtrees are searched by a multiprocessing pool. Results
+        come back in the same order as from the serial search.
+    """
+    if processes is not None and processes > 1 and n > SPLIT_DEPTH:
+        yield from _parallel(n, symmetry, processes)
+        return
+    transforms = _TRANSFORMS[symmetry][1:]
+    for p in fixed(n):
+        p = normalized(p)
+        if _keep(p, transforms):
+            yield p
+
+def _parallel(n, symmetry, processes):
+    tasks = ((n, symmetry) + prefix
+             for prefix in _prefixes(SPLIT_DEPTH, [], {(0,0)}, [(0,0)]))
+    with multiprocessing.Pool(processes) as pool:
+        for ret in pool.imap(_subtree, tasks, chunksize=4):
+            yield from ret
+
+def count(n, symmetry=Symmetry.ONE_SIDED, processes=None):
+    return sum(1 for p in polyominoes(n, symmetry, processes))
+
+if __name__ == "__main__":
+    # Self-check: python -m ntris.nminoenum [max_n]
+    import sys
+    top = int(sys.argv[1]) if len(sys.argv) > 1 else 9
+    for symmetry in Symmetry:
+        for n in range(1, top+1):
+            got = count(n, symmetry)
+            if got != COUNTS[symmetry][n]:
+                sys.exit("{} n={}: {} polyominoes, expected {}"
+                         .format(symmetry.name, n, got, COUNTS[symmetry][n]))
+        print("{}: n=1..{} ok".format(symmetry.name, top))
+    if top > SPLIT_DEPTH and list(polyominoes(top, processes=2)) != list(polyominoes(top)):
+        sys.exit("parallel enumeration differs from the serial one")
+    print("parallel n={} ok".format(top))
@@ -0,0 +1,209 @@
+# MIT License
+#
+# Copyright (c) 2016 Marcin Zubilewicz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+On-disk polyomino libraries.
+
+A library file holds every polyomino of one size under one symmetry:
+
+  header  : magic, format version, n, symmetry, mask width, count
+  offsets : count pairs of int8 - the shift from mask coordinates to the
+            barycentric coordinates used by nMino,
+  masks   : count little-endian bitmasks of 'width' bytes each, in the
+            encoding of nminoenum.encode. Every mask is the canonical key
+            of its pattern (see nminoenum.key).
+
+Files are written once (atomically) and then mapped read-only, so loading
+is cheap and all processes share the same pages.
+"""
+
+import ntris.nminoenum as nminoenum
+
+from os.path import expanduser, join
+import mmap
+import multiprocessing
+import os
+import struct
+import tempfile
+
+CACHE_DIR = expanduser("~/.ntris-cache")
+MAGIC   = b"NTRL"
+VERSION = 2
+HEADER  = struct.Struct("<4sHHBxHI")
+
+def mask_width(n):
+    return (n*n+7)//8
+
+def offset(cells):
+    # Same rounding as nMino.barycenter.
+    n = len(cells)
+    return (-int(round(sum(x for x,y in cells)/n)),
+            -int(round(sum(y for x,y in cells)/n)))
+
+def path(n, symmetry):
+    return join(CACHE_DIR, "nmino-{}-{}.lib".format(symmetry.name.lower(), n))
+
+def build(n, symmetry=nminoenum.Symmetry.ONE_SIDED, processes=None):
+    """
+    build(n, symmetry=Symmetry.ONE_SIDED, processes=None)
+        Enumerates the library and writes it to 'path(n, symmetry)'. The file
+        appears atomically, so concurrent builders and readers are safe.
+    """
+    width = mask_width(n)
+    offsets = bytearray()
+    masks = bytearray()
+    for p in nminoenum.polyominoes(n, symmetry, processes):
+        offsets.extend(struct.pack("<bb", *offset(p)))
+        masks.extend(nminoenum.encode(p, n).to_bytes(width, "little"))
+    count = len(offsets)//2
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, prefix=".nmino-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, n, symmetry.value, width, count))
+            f.write(offsets)
+            f.write(masks)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path(n, symmetry))
+    except:
+        os.unlink(tmp)
+        raise
+    return path(n, symmetry)
+
+class Library:
+    """
+    Library - a read-only view of a library file.
+
+    Methods:
+      __init__(filename)
+      __len__()
+      __getitem__(i) : frozenset of cells of pattern i, in nMino coordinates
+      mask(i)        : bitmask of pattern i
+
+    Raises ValueError if the file is not a library of the current VERSION.
+    """
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._buf) < HEADER.size:
+            raise ValueError("truncated library file")
+        magic, version, n, sym, width, count = HEADER.unpack_from(self._buf)
+        if magic != MAGIC or version != VERSION or \
+           len(self._buf) != HEADER.size + count*(2+width):
+            raise ValueError("not a library file (version {})".format(VERSION))
+        self.ncomps = n
+        self.symmetry = nminoenum.Symmetry(sym)
+        self.width = width
+        self.count = count
+        self._offsets = HEADER.size
+        self._masks = HEADER.size + 2*count
+
+    def __len__(self):
+        return self.count
+
+    def mask(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError("pattern index out of range")
+        a = self._masks + i*self.width
+        return int.from_bytes(self._buf[a:a+self.width], "little")
+
+    def __getitem__(self, i):
+        dx, dy = struct.unpack_from("<bb", self._buf, self._offsets + 2*i)
+        cells = nminoenum.decode(self.mask(i), self.ncomps)
+        return frozenset((x+dx, y+dy) for x,y in cells)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+_loaded = {}
+_pending = {}
+_pool = None
+
+def _open(n, symmetry):
+    # The cached library of 'n' and 'symmetry'. A file with another n or
+    # symmetry in its header (renamed, or stale) is rejected like a file of
+    # another version, so it gets rebuilt.
+    lib = Library(path(n, symmetry))
+    if lib.ncomps != n or lib.symmetry != symmetry or lib.width != mask_width(n):
+        lib._buf.close()
+        raise ValueError("library file holds n={} {}, expected n={} {}"
+                         .format(lib.ncomps, lib.symmetry.name, n, symmetry.name))
+    return lib
+
+def load(n, symmetry=nminoenum.Symmetry.ONE_SIDED, processes=None):
+    """
+    load(n, symmetry=Symmetry.ONE_SIDED, processes=None)
+        Returns the Library of n-ominoes, mapping the cached file if there is
+        a valid one and building it first otherwise. Libraries stay open for
+        the lifetime of the process.
+    """
+    key = (n, symmetry)
+    if key in _pending:
+        _pending.pop(key).wait()
+    if key not in _loaded:
+        try:
+            lib = _open(n, symmetry)
+        except (OSError, ValueError):
+            build(n, symmetry, processes)
+            lib = _open(n, symmetry)
+        _loaded[key] = lib
+    return _loaded[key]
+
+def prefetch(n, symmetry=nminoenum.Symmetry.ONE_SIDED):
+    """
+    prefetch(n, symmetry=Symmetry.ONE_SIDED)
+        Makes sure the library will be cached without blocking: maps it if
+        the file is already valid, otherwise starts 'build' in a background
+        worker process (a serial one - pool workers can't have children).
+        See 'ready'.
+    """
+    global _pool
+    key = (n, symmetry)
+    if key in _loaded or key in _pending:
+        return
+    try:
+        _loaded[key] = _open(n, symmetry)
+    except (OSError, ValueError):
+        if _pool is None:
+            _pool = multiprocessing.Pool(1)
+        _pending[key] = _pool.apply_async(build, (n, symmetry))
+
+def ready(n, symmetry=nminoenum.Symmetry.ONE_SIDED):
+    """
+    ready(n, symmetry=Symmetry.ONE_SIDED)
+        True if 'load' would return at once, i.e. the library is mapped or
+        its background build has finished. A build that failed is dropped
+        and the library stays not ready, so callers keep sampling instead
+        of building it in the foreground.
+    """
+    key = (n, symmetry)
+    if key in _pending:
+        result = _pending[key]
+        if not result.ready():
+            return False
+        if not result.successful():
+            del _pending[key]
+            return False
+        return True
+    return key in _loaded
@@ -24,39 +24,105 @@ import pygame
 import ntris.ui
 import ntris.position
 import ntris.nmino as nm
+import ntris.randomizer
+
+from collections import deque
 
 class nMinoPrev(ntris.ui.Area):
+    """
+    nMinoPrev - shows the upcoming pieces.
+    
+      The first of 'lookahead' queued pieces is drawn in the area itself,
+      the rest in a column of half-sized slots below it. One more piece is
+      kept in reserve and the queue is topped up by 'update', one piece per
+      call, so 'get' normally only pops a ready piece.
+      
+      Pieces entering the queue get their sprites drawn right away (see
+      nMino.sprite): at the sizes of the preview slots, and, if 'stage' is
+      given, every rotation state at every size it can take on the stage
+      (see Stage.screen_sizes). Call 'prewarm' when the stage's cells
+      change size.
+    """
     
-    def __init__(self, rect, gen, margin=10):
+    def __init__(self, rect, gen, margin=10, lookahead=1, randomizer=None,
+                 stage=None):
         super().__init__(rect)
         if not isinstance(gen, nm.nMinoGen):
             TypeError("nMinoGen expected as second argument")
         self.nminogen = gen
-        self.nmino = None
+        self.randomizer = randomizer if randomizer else \
+                          ntris.randomizer.UniformRandomizer(gen)
         self.margin = margin
-        self._draw_rect = None
-        self.get()
+        self.lookahead = lookahead
+        self.stage = stage
+        self.queue = deque()
+        self._ncomps = gen.max_size()
+        while len(self.queue) <= self.lookahead:
+            self.update(0)
+    
+    @property
+    def nmino(self):
+        return self.queue[0][0] if self.queue else None
     
     def draw(self, surface):
         super().draw(surface)
-        self.nmino.draw(surface.subsurface(self._draw_rect))
+        for i, (nmino, size) in enumerate(self.queue):
+            if i >= self.lookahead:
+                break
+            nmino.draw(surface.subsurface(self._slot_rect(i, size)))
+    
+    @property
+    def full_rect(self):
+        # The area and every slot below it, whatever pieces are queued.
+        rect = super().full_rect
+        for i in range(1, self.lookahead):
+            rect.union_ip(self._slot_rect(i, self._rect.size))
+        return rect
+    
+    def _slot_rect(self, i, size):
+        if not i:
+            rect = pygame.Rect((0,0), size)
+            rect.center = self._rect.center
+        else:
+            h = self._rect.h//2
+            rect = pygame.Rect((0,0), (size[0]//2, size[1]//2))
+            rect.center = (self._rect.centerx, self._rect.bottom + h//2 +
+                           self.margin + (i-1)*(h+self.margin))
+        return rect
+    
+    def update(self, dt):
+        if self.nminogen.max_size() != self._ncomps:
+            self._ncomps = self.nminogen.max_size()
+            while len(self.queue) > 1:
+                self.queue.pop()
+        if len(self.queue) <= self.lookahead:
+            self.queue.append(self._entry(self.randomizer.next()))
         
     def get(self):
-        ret = self.nmino
-        self.put(self.nminogen.generate())
-        return ret
+        if len(self.queue) < 2:
+            self.update(0)
+        return self.queue.popleft()[0]
     
     def put(self, nmino):
-        self.nmino = nmino
-        
+        self.queue.appendleft(self._entry(nmino))
+    
+    def _entry(self, nmino):
         max = self.nminogen.max_size()
         temprect = ntris.position.rect_inflate(self._rect, -self.margin, -self.margin)
         size = min(temprect.size)//max
-        
-        bounds = self.nmino.bounds()
-        n,m = bounds.size
-        bounds.size = n*size, m*size
-        bounds.center = self._rect.center
-        
-        self._draw_rect = bounds
-        
\ No newline at end of file
+        n,m = nmino.width, nmino.height
+        self._prewarm(nmino, (n*size, m*size))
+        return nmino, (n*size, m*size)
+    
+    def prewarm(self):
+        for nmino, size in self.queue:
+            self._prewarm(nmino, size)
+    
+    def _prewarm(self, nmino, size):
+        # Slot 0 shows the piece at 'size', the slots below at half of it.
+        nmino.sprite(size)
+        nmino.sprite((size[0]//2, size[1]//2))
+        if self.stage is not None:
+            for state in nmino.rotation_table().states:
+                for wh in self.stage.screen_sizes(state.bounds().size):
+                    state.sprite(wh)
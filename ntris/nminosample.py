@@ -0,0 +1,199 @@
+# MIT License
+#
+# Copyright (c) 2016 Marcin Zubilewicz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Random polyominoes too large to enumerate.
+
+'sample' draws fixed polyominoes from (approximately) the uniform
+distribution with a Metropolis chain over polyominoes of size n:
+
+  1. pick a cell c of the polyomino P uniformly,
+  2. pick a cell p uniformly from the perimeter of P - {c},
+  3. move c to p if the result is connected, otherwise stay.
+
+Step 2 chooses from the same set in both directions (P - {c} is also
+P' - {p}), so the proposal is symmetric and the chain's stationary
+distribution is uniform over fixed polyominoes. The chain starts from an
+Eden growth cluster and runs SWEEPS*n steps, which is the mixing budget;
+shorter budgets leave a bias towards the compact shapes Eden growth makes.
+"""
+
+import collections
+import random
+
+SWEEPS = 20
+
+_ORTHO = ((1,0), (0,1), (-1,0), (0,-1))
+# The 8 cells around a cell, in circular order.
+_RING = ((0,-1), (1,-1), (1,0), (1,1), (0,1), (-1,1), (-1,0), (-1,-1))
+
+class _IndexedSet:
+    # A set with O(1) add, remove and uniform choice.
+    def __init__(self):
+        self.items = []
+        self.index = {}
+
+    def __contains__(self, x):
+        return x in self.index
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, x):
+        if x not in self.index:
+            self.index[x] = len(self.items)
+            self.items.append(x)
+
+    def remove(self, x):
+        i = self.index.pop(x)
+        last = self.items.pop()
+        if i < len(self.items):
+            self.items[i] = last
+            self.index[last] = i
+
+    def choice(self, rng):
+        return self.items[rng.randrange(len(self.items))]
+
+class _Animal:
+    # A cell set with its perimeter (empty cells next to it), kept current.
+    def __init__(self):
+        self.cells = _IndexedSet()
+        self.perimeter = _IndexedSet()
+        self.nbrs = collections.Counter()
+
+    def add(self, c):
+        if c in self.perimeter:
+            self.perimeter.remove(c)
+        self.cells.add(c)
+        x,y = c
+        for dx,dy in _ORTHO:
+            d = (x+dx, y+dy)
+            self.nbrs[d] += 1
+            if d not in self.cells:
+                self.perimeter.add(d)
+
+    def remove(self, c):
+        self.cells.remove(c)
+        x,y = c
+        for dx,dy in _ORTHO:
+            d = (x+dx, y+dy)
+            self.nbrs[d] -= 1
+            if not self.nbrs[d]:
+                del self.nbrs[d]
+                if d in self.perimeter:
+                    self.perimeter.remove(d)
+        if self.nbrs[c]:
+            self.perimeter.add(c)
+        else:
+            del self.nbrs[c]
+
+    def locally_simple(self, c):
+        # True if the neighbours of c stay connected around c without it,
+        # i.e. at most one run of occupied ring cells touches c.
+        x,y = c
+        cells = self.cells.index
+        ring = [(x+dx, y+dy) in cells for dx,dy in _RING]
+        if all(ring):
+            return True
+        start = ring.index(False)
+        runs, in_run, touches = 0, False, False
+        for k in range(1, 9):
+            i = (start+k) % 8
+            if ring[i]:
+                if not in_run:
+                    in_run, touches = True, False
+                touches = touches or i % 2 == 0
+            else:
+                if in_run and touches:
+                    runs += 1
+                in_run = False
+        return runs <= 1
+
+    def connected_around(self, c):
+        # Lockstep flood fill from each orthogonal neighbour of c. The fills
+        # merge when they meet; the cells are disconnected as soon as some
+        # group of fills runs out of cells before meeting the others, so a
+        # cut costs about (number of fills) * (size of the smaller side).
+        x,y = c
+        cells = self.cells.index
+        seeds = [(x+dx, y+dy) for dx,dy in _ORTHO if (x+dx, y+dy) in cells]
+        k = len(seeds)
+        parent = list(range(k))
+        def find(i):
+            while parent[i] != i:
+                i = parent[i]
+            return i
+        owner = {s: i for i,s in enumerate(seeds)}
+        fronts = [[s] for s in seeds]
+        groups = k
+        while groups > 1:
+            for i in range(k):
+                front = fronts[i]
+                if not front:
+                    r = find(i)
+                    if not any(fronts[j] for j in range(k) if find(j) == r):
+                        return False
+                    continue
+                u,v = front.pop()
+                for d in ((u+1,v), (u,v+1), (u-1,v), (u,v-1)):
+                    if d in cells:
+                        j = owner.get(d)
+                        if j is None:
+                            owner[d] = i
+                            front.append(d)
+                        elif parent[j] != parent[i] and find(i) != find(j):
+                            parent[find(j)] = find(i)
+                            groups -= 1
+        return True
+
+def _eden(n, rng):
+    animal = _Animal()
+    animal.add((0,0))
+    while len(animal.cells) < n:
+        animal.add(animal.perimeter.choice(rng))
+    return animal
+
+def sample(n, rng=random, sweeps=SWEEPS):
+    """
+    sample(n, rng=random, sweeps=SWEEPS)
+        Returns a random fixed polyomino of size 'n' as a list of (x,y)
+        cells, approximately uniformly distributed after 'sweeps'*n steps
+        of the chain described above. Each step takes O(1) time except
+        when the moved cell is a local cut point, in which case only the
+        smaller side of the cut is flood-filled.
+    """
+    animal = _eden(n, rng)
+    if n < 2:
+        return list(animal.cells.items)
+    for step in range(sweeps*n):
+        c = animal.cells.choice(rng)
+        simple = animal.locally_simple(c)
+        animal.remove(c)
+        p = animal.perimeter.choice(rng)
+        if p == c:
+            animal.add(c)
+            continue
+        animal.add(p)
+        if not simple and not animal.connected_around(c):
+            animal.remove(p)
+            animal.add(c)
+    return list(animal.cells.items)
@@ -0,0 +1,321 @@
+# MIT License
+#
+# Copyright (c) 2016 Marcin Zubilewicz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Puzzles: pre-filled stages together with a piece sequence that clears them.
+
+The bottom 'rows' rows of a stage get a random skyline of garbage. The
+cells above it are covered exactly by library pieces, found with Knuth's
+Algorithm X on dancing links. The pieces are then ordered so that each one
+can be dropped straight down and rests exactly where the cover put it;
+the order is checked by replaying the drops.
+"""
+
+import ntris.blocks
+import ntris.nmino as nm
+import ntris.nminolib
+import ntris.stage
+
+import multiprocessing
+import random
+import time
+
+GARBAGE_COLOR = (128,128,128)
+
+class Timeout(Exception):
+    pass
+
+class DLX:
+    """
+    DLX - exact cover solver (Algorithm X with dancing links).
+
+    Methods:
+      __init__(ncols, rows) : 'rows' is a sequence of lists of column
+                              indices in range(ncols)
+      solve(deadline=None)  : yields solutions as lists of row indices;
+                              raises Timeout once time.perf_counter()
+                              passes 'deadline'. A DLX that timed out
+                              can't be used again.
+    """
+    CHECK_EVERY = 1024
+
+    def __init__(self, ncols, rows):
+        # Node 0 is the root, nodes 1..ncols the column headers.
+        n = ncols+1
+        self.L = [i-1 for i in range(n)]
+        self.R = [i+1 for i in range(n)]
+        self.L[0], self.R[ncols] = ncols, 0
+        self.U = list(range(n))
+        self.D = list(range(n))
+        self.C = list(range(n))
+        self.S = [0]*n
+        self.row = [-1]*n
+        L, R, U, D, C, S = self.L, self.R, self.U, self.D, self.C, self.S
+        for r, cols in enumerate(rows):
+            first = None
+            for c in cols:
+                c += 1
+                node = len(L)
+                C.append(c)
+                self.row.append(r)
+                U.append(U[c])
+                D.append(c)
+                D[U[c]] = node
+                U[c] = node
+                S[c] += 1
+                if first is None:
+                    first = node
+                    L.append(node)
+                    R.append(node)
+                else:
+                    L.append(L[first])
+                    R.append(first)
+                    R[L[first]] = node
+                    L[first] = node
+
+    def _cover(self, c):
+        L, R, U, D, C, S = self.L, self.R, self.U, self.D, self.C, self.S
+        R[L[c]] = R[c]
+        L[R[c]] = L[c]
+        i = D[c]
+        while i != c:
+            j = R[i]
+            while j != i:
+                U[D[j]] = U[j]
+                D[U[j]] = D[j]
+                S[C[j]] -= 1
+                j = R[j]
+            i = D[i]
+
+    def _uncover(self, c):
+        L, R, U, D, C, S = self.L, self.R, self.U, self.D, self.C, self.S
+        i = U[c]
+        while i != c:
+            j = L[i]
+            while j != i:
+                S[C[j]] += 1
+                U[D[j]] = j
+                D[U[j]] = j
+                j = L[j]
+            i = U[i]
+        R[L[c]] = c
+        L[R[c]] = c
+
+    def solve(self, deadline=None):
+        self._deadline = deadline
+        self._nodes = 0
+        yield from self._search([])
+
+    def _search(self, solution):
+        R, D, S = self.R, self.D, self.S
+        if R[0] == 0:
+            yield list(solution)
+            return
+        self._nodes += 1
+        if self._deadline is not None and not self._nodes % self.CHECK_EVERY \
+           and time.perf_counter() > self._deadline:
+            raise Timeout()
+        c, j = R[0], R[R[0]]
+        while j != 0:
+            if S[j] < S[c]:
+                c = j
+            j = R[j]
+        if not S[c]:
+            return
+        self._cover(c)
+        r = D[c]
+        while r != c:
+            solution.append(self.row[r])
+            j = R[r]
+            while j != r:
+                self._cover(self.C[j])
+                j = R[j]
+            yield from self._search(solution)
+            j = self.L[r]
+            while j != r:
+                self._uncover(self.C[j])
+                j = self.L[j]
+            solution.pop()
+            r = D[r]
+        self._uncover(c)
+
+class Puzzle:
+    """
+    Puzzle - a stage layout and the pieces that clear it.
+
+    Attributes:
+      size    : stage grid size
+      garbage : list of (x,y) stage cells that start filled
+      pieces  : list of (pattern, state, (x,y)) in dropping order - a
+                pattern index of the nMinoGen library, its rotation state
+                and the stage position of the piece (see nMinoCtl.pos_stage)
+    """
+    def __init__(self, size, garbage, pieces):
+        self.size = size
+        self.garbage = garbage
+        self.pieces = pieces
+
+    def patterns(self):
+        return [p for p,s,pos in self.pieces]
+    
+    def sequence(self):
+        # (pattern, rotation state) of every piece, for SequenceRandomizer.
+        return [(p,s) for p,s,pos in self.pieces]
+
+    def apply(self, stage):
+        if stage.gridsize != self.size:
+            raise ValueError("puzzle for a {} stage, got {}"
+                             .format(self.size, stage.gridsize))
+        for pos in self.garbage:
+            stage.add_obstacle(pos, ntris.blocks.Block(GARBAGE_COLOR))
+
+def _skyline(width, rows, n, rng):
+    # Random column heights below 'rows', with at least one empty column
+    # and a number of empty cells divisible by n.
+    while True:
+        heights = [rng.randrange(rows) for x in range(width)]
+        hole = rng.randrange(width)
+        heights[hole] = 0
+        extra = (width*rows - sum(heights)) % n
+        grow = [x for x in range(width) if x != hole and heights[x] < rows-1]
+        if len(grow) >= extra:
+            for x in rng.sample(grow, extra):
+                heights[x] += 1
+            return heights
+
+def _drop_order(cover, rng):
+    # Piece b has to come after piece a if some cell of b is above a cell
+    # of a in the same column. Returns a random topological order, or None
+    # if the constraints are cyclic.
+    top = {}
+    for k, (p, s, cells) in enumerate(cover):
+        for x,y in cells:
+            top[x] = top.get(x, []) + [(y,k)]
+    after = [set() for c in cover]
+    for col in top.values():
+        col.sort()
+        for (y1,a), (y2,b) in zip(col, col[1:]):
+            if a != b:
+                after[b].add(a)
+    indeg = [0]*len(cover)
+    for a, s in enumerate(after):
+        for b in s:
+            indeg[b] += 1
+    ready = [k for k,d in enumerate(indeg) if not d]
+    order = []
+    while ready:
+        k = ready.pop(rng.randrange(len(ready)))
+        order.append(k)
+        for b in after[k]:
+            indeg[b] -= 1
+            if not indeg[b]:
+                ready.append(b)
+    return order if len(order) == len(cover) else None
+
+def _replay(size, garbage, cover, order):
+    # Drops every piece straight down from above the stage.
+    filled = set(garbage)
+    w, h = size
+    for k in order:
+        p, s, cells = cover[k]
+        dy = -h
+        while all(y+dy+1 < h and (x, y+dy+1) not in filled for x,y in cells):
+            dy += 1
+        if dy:
+            return False
+        filled.update(cells)
+    return True
+
+def generate(gen, width, rows, rng=random, budget=0.5, max_patterns=32):
+    """
+    generate(gen, width, rows, rng=random, budget=0.5, max_patterns=32)
+        Returns a Puzzle for a stage of grid width 'width' whose bottom
+        'rows' rows are cleared by pieces of the nMinoGen 'gen', or None if
+        no cover was found within 'budget' seconds. At most 'max_patterns'
+        library patterns, drawn at random, are offered to the solver.
+    """
+    if gen.patterns is None:
+        raise ValueError("nMinoGen has no pattern library (n={})".format(gen.max_size()))
+    n = gen.max_size()
+    size = ntris.stage.stage_dims(width)
+    h = size[1]
+    heights = _skyline(width, rows, n, rng)
+    garbage = [(x,y) for x in range(width) for y in range(h-heights[x], h)]
+    empty = {(x,y) for x in range(width) for y in range(h-rows, h-heights[x])}
+    column = {c: i for i,c in enumerate(sorted(empty))}
+
+    ids = list(range(len(gen.patterns)))
+    if len(ids) > max_patterns:
+        ids = rng.sample(ids, max_patterns)
+    placements = []
+    for p in ids:
+        for s, state in enumerate(gen.rotations(p).states):
+            b = state.bounds()
+            for X in range(-b.left, width-b.right+1):
+                for Y in range(h-rows-b.top, h-b.bottom+1):
+                    cells = [(X+x, Y+y) for x,y in state]
+                    if all(c in empty for c in cells):
+                        placements.append((p, s, (X,Y), cells))
+    rng.shuffle(placements)
+
+    deadline = time.perf_counter() + budget
+    solver = DLX(len(column), [[column[c] for c in pl[3]] for pl in placements])
+    try:
+        for solution in solver.solve(deadline):
+            cover = [(placements[r][0], placements[r][1], placements[r][3])
+                     for r in solution]
+            order = _drop_order(cover, rng)
+            if order is not None and _replay(size, garbage, cover, order):
+                pieces = [(placements[solution[k]][0], placements[solution[k]][1],
+                           placements[solution[k]][2]) for k in order]
+                return Puzzle(size, garbage, pieces)
+    except Timeout:
+        pass
+    return None
+
+def _generate_seeded(args):
+    # Runs in pool workers, which can't start the library's build process.
+    n, width, rows, seed, budget = args
+    gen = nm.nMinoGen(n, background=False)
+    return generate(gen, width, rows, random.Random(seed), budget)
+
+def generate_many(n, count, width, rows, seed=0, budget=0.5, processes=None):
+    """
+    generate_many(n, count, width, rows, seed=0, budget=0.5, processes=None)
+        Yields up to 'count' puzzles for n-ominoes, one attempt per seed
+        seed, seed+1, ... (attempts that time out yield nothing). With
+        'processes' > 1 the attempts run in a multiprocessing pool; the
+        output is the same as the serial one.
+    """
+    # Build the library once up front; the workers then only map it.
+    ntris.nminolib.load(n, nm.nMinoGen.SYMMETRY)
+    tasks = [(n, width, rows, seed+i, budget) for i in range(count)]
+    if processes is not None and processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            for puzzle in pool.imap(_generate_seeded, tasks, chunksize=8):
+                if puzzle is not None:
+                    yield puzzle
+    else:
+        for t in tasks:
+            puzzle = _generate_seeded(t)
+            if puzzle is not None:
+                yield puzzle
@@ -0,0 +1,148 @@
+# MIT License
+#
+# Copyright (c) 2016 Marcin Zubilewicz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import ntris.nmino as nm
+
+from array import array
+import random
+
+class Randomizer:
+    """
+    Randomizer - decides which piece of an nMinoGen library comes next.
+
+      Subclasses implement 'pick', returning a pattern index. The state is
+      rebuilt by 'reset' whenever the generator switches libraries. While
+      there is no library (huge pieces, or one still being built), pieces
+      come straight from nMinoGen.generate.
+
+    Methods:
+      __init__(gen)
+      next()  : the next nMino
+      reset() : called when the library changes
+      pick()  : index of the next pattern
+    """
+    def __init__(self, gen):
+        if not isinstance(gen, nm.nMinoGen):
+            raise TypeError("nMinoGen expected")
+        self.gen = gen
+        self._patterns = None
+
+    def next(self):
+        gen = self.gen
+        if gen.patterns is None:
+            return gen.generate()
+        if gen.patterns is not self._patterns:
+            self._patterns = gen.patterns
+            self.reset()
+        return gen.spawn(self.pick())
+
+    def reset(self):
+        pass
+
+    def pick(self):
+        return random.randrange(len(self._patterns))
+
+class UniformRandomizer(Randomizer):
+    """
+    UniformRandomizer - every pattern is equally likely, every time.
+    """
+    pass
+
+class BagRandomizer(Randomizer):
+    """
+    BagRandomizer - deals every pattern of the library once, in random
+      order, before any pattern repeats.
+
+      The bag is a permutation shuffled one draw at a time (Fisher-Yates),
+      so a draw costs O(1) even for libraries of hundreds of thousands of
+      patterns.
+    """
+    def reset(self):
+        self._bag = array("I", range(len(self._patterns)))
+        self._left = len(self._bag)
+
+    def pick(self):
+        if not self._left:
+            self._left = len(self._bag)
+        j = random.randrange(self._left)
+        self._left -= 1
+        bag, last = self._bag, self._left
+        bag[j], bag[last] = bag[last], bag[j]
+        return bag[last]
+
+class WeightedRandomizer(Randomizer):
+    """
+    WeightedRandomizer - pattern i is drawn with probability proportional
+      to weight(gen, i).
+
+      Uses Vose's alias method: O(len(library)) to build the tables on
+      every library change, O(1) per draw.
+    """
+    def __init__(self, gen, weight):
+        super().__init__(gen)
+        self.weight = weight
+
+    def reset(self):
+        n = len(self._patterns)
+        w = [float(self.weight(self.gen, i)) for i in range(n)]
+        total = sum(w)
+        if total <= 0:
+            raise ValueError("weights have to sum up to a positive number")
+        prob = [x*n/total for x in w]
+        self._prob  = array("d", [1.0]*n)
+        self._alias = array("I", range(n))
+        small = [i for i,p in enumerate(prob) if p < 1.0]
+        large = [i for i,p in enumerate(prob) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self._prob[s]  = prob[s]
+            self._alias[s] = l
+            prob[l] -= 1.0 - prob[s]
+            (small if prob[l] < 1.0 else large).append(l)
+
+    def pick(self):
+        i = random.randrange(len(self._prob))
+        return i if random.random() < self._prob[i] else self._alias[i]
+
+class SequenceRandomizer(Randomizer):
+    """
+    SequenceRandomizer - deals the given pieces in order, then carries on
+      uniformly at random.
+
+      A piece is a pattern index, dealt in a random rotation state, or a
+      (pattern, state) pair, dealt in exactly that state (e.g.
+      puzzle.Puzzle.sequence()).
+    """
+    def __init__(self, gen, pieces):
+        super().__init__(gen)
+        self.pieces = list(pieces)
+        self._next = 0
+
+    def next(self):
+        if self._next < len(self.pieces) and self.gen.patterns is not None:
+            piece = self.pieces[self._next]
+            self._next += 1
+            if isinstance(piece, tuple):
+                pattern, state = piece
+                return self.gen.rotations(pattern)[state]
+            return self.gen.spawn(piece)
+        return super().next()
@@ -0,0 +1,284 @@
+# MIT License
+#
+# Copyright (c) 2016 Marcin Zubilewicz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Where can a piece go? Every placement a falling piece can reach by moving
+left, right and down and rotating the way nMinoCtl does (no kicks, so
+tucks and spins are found, but only when they are legal moves).
+
+The search works on bitsets. For every rotation state and row, one int
+holds the positions x where the piece fits ('free'), computed with a
+shift per piece cell from the stage's row masks. Reachable positions are
+then spread a row at a time: along the row with logarithmic flood fills,
+between rotation states with an AND, and down into the next row with
+another AND. Input paths are only worked out, by a plain breadth-first
+search, when asked for.
+
+Positions are stage positions of the piece's origin, as in
+nMinoCtl.pos_stage; bit X of a mask stands for x = X - Reach.offset.
+"""
+
+from ntris.position import Dir, Spin
+
+from collections import deque
+
+def _shift(v, k):
+    return v << k if k >= 0 else v >> -k
+
+def _fill(r, f):
+    # Bits of f connected to the bits of r through runs of f.
+    up, p = r, f
+    dn, q = r, f
+    k = 1
+    while p or q:
+        up |= p & (up << k)
+        dn |= q & (dn >> k)
+        p &= p << k
+        q &= q >> k
+        k <<= 1
+    return up | dn
+
+class Reach:
+    """
+    Reach - the placements reachable by a piece.
+    
+    Methods:
+      __init__(stage, rotations, state, pos) : a piece of the Rotations
+                       'rotations' in state 'state' at the stage position
+                       'pos'; the piece itself must not be among the
+                       stage's active pieces (see nMinoCtl.active)
+      placements()   : list of (x, y, state) where the piece rests
+      reachable(x, y, state)
+      path(x, y, state) : shortest list of Dir/Spin inputs from the start
+                       to (x, y, state), or None if it can't be reached
+    
+    Attributes:
+      free  : free[state][y] - mask of the positions where the piece fits
+      reach : reach[state][y] - mask of the reachable positions
+    """
+    def __init__(self, stage, rotations, state, pos):
+        self.stage = stage
+        self.rotations = rotations
+        self.start = (pos[0], pos[1], state)
+        w, h = stage.gridsize
+        self.offset = max(-b.left for b in rotations.bounds)
+        rows = stage.block_array.masks
+        if stage.nactive:
+            rows = [m | a for m,a in zip(rows, stage.active)]
+        self.free = [self._free(rows, w, h, rotations.masks[s], rotations.bounds[s])
+                     for s in range(rotations.order)]
+        self.reach = [[0]*h for s in range(rotations.order)]
+        self._parents = None
+        x, y, s = self.start
+        X = x + self.offset
+        if X >= 0 and self.free[s][y] >> X & 1:
+            self._spread(s, y, 1 << X)
+    
+    def _free(self, rows, w, h, masks, bounds):
+        off = self.offset
+        lo = off - bounds.left
+        hi = w - bounds.width - bounds.left + off
+        span = ((1 << (hi-lo+1)) - 1) << lo if hi >= lo else 0
+        free = []
+        for y in range(h):
+            top = y + bounds.top
+            if top < 0 or top + len(masks) > h:
+                free.append(0)
+                continue
+            blocked = 0
+            for i,m in enumerate(masks):
+                row = rows[top+i]
+                if not row:
+                    continue
+                j = 0
+                while m:
+                    if m & 1:
+                        blocked |= _shift(row, off - bounds.left - j)
+                    m >>= 1
+                    j+= 1
+            free.append(span & ~blocked)
+        return free
+    
+    def _spread(self, s0, y0, seed):
+        free, reach = self.free, self.reach
+        order = self.rotations.order
+        h = len(free[0])
+        cur = [0]*order
+        cur[s0] = seed
+        for y in range(y0, h):
+            changed = True
+            while changed:
+                changed = False
+                for s in range(order):
+                    cur[s] = _fill(cur[s], free[s][y])
+                for s in range(order):
+                    for t in ((s+1) % order, (s-1) % order):
+                        add = cur[s] & free[t][y] & ~cur[t]
+                        if add:
+                            cur[t] |= add
+                            changed = True
+            if not any(cur):
+                break
+            for s in range(order):
+                reach[s][y] = cur[s]
+                cur[s] = cur[s] & free[s][y+1] if y+1 < h else 0
+    
+    def placements(self):
+        ret = []
+        off = self.offset
+        for s, (reach, free) in enumerate(zip(self.reach, self.free)):
+            for y, r in enumerate(reach):
+                if y+1 < len(free):
+                    r &= ~free[y+1]
+                while r:
+                    low = r & -r
+                    ret.append((low.bit_length()-1-off, y, s))
+                    r ^= low
+        return ret
+    
+    def reachable(self, x, y, state):
+        X = x + self.offset
+        return X >= 0 and 0 <= y < len(self.reach[state]) and \
+               bool(self.reach[state][y] >> X & 1)
+    
+    def _moves(self, x, y, s):
+        order = self.rotations.order
+        yield Dir.LEFT,  (x-1, y, s)
+        yield Dir.RIGHT, (x+1, y, s)
+        yield Dir.DOWN,  (x, y+1, s)
+        if order > 1:
+            yield Spin.CLOCKWISE, (x, y, (s+1) % order)
+        if order > 2:
+            yield Spin.COUNTERCLOCKWISE, (x, y, (s-1) % order)
+    
+    def path(self, x, y, state):
+        if not self.reachable(x, y, state):
+            return None
+        if self._parents is None:
+            parents = {self.start: None}
+            queue = deque([self.start])
+            while queue:
+                node = queue.popleft()
+                for move, nxt in self._moves(*node):
+                    if nxt not in parents and self.reachable(*nxt):
+                        parents[nxt] = (node, move)
+                        queue.append(nxt)
+            self._parents = parents
+        path = []
+        node = (x, y, state)
+        while self._parents[node] is not None:
+            node, move = self._parents[node]
+            path.append(move)
+        return path[::-1]
+
+def reach(nmc):
+    """
+    reach(nmc)
+        Reach of the piece of the nMinoCtl 'nmc' from where it is now.
+    """
+    active = nmc.active
+    nmc._lift()
+    try:
+        return Reach(nmc.stage, nmc.rotations, nmc.state, nmc.pos_stage)
+    finally:
+        if active:
+            nmc._place()
+
+def placements(nmc):
+    """
+    placements(nmc)
+        List of ((x, y, state), path) for every resting placement the piece
+        of 'nmc' can reach; 'path' is a shortest list of inputs getting
+        there (move / rotate arguments), not including the final lock.
+    """
+    r = reach(nmc)
+    return [(p, r.path(*p)) for p in r.placements()]
+
+if __name__ == "__main__":
+    # Self-check: python -m ntris.reach [trials]
+    # Compares Reach with a breadth-first search over nMinoCtl's own moves
+    # on random stages, and replays a few of the paths.
+    import ntris.blocks as blk
+    import ntris.nmino as nm
+    import ntris.nminoctl as ctl
+    import ntris.stage as stg
+    import random
+    import sys
+    
+    MOVES = (Dir.LEFT, Dir.RIGHT, Dir.DOWN, Spin.CLOCKWISE, Spin.COUNTERCLOCKWISE)
+    
+    def apply(nmc, move):
+        return nmc.move(move) if isinstance(move, Dir) else nmc.rotate(move)
+    
+    def brute(nmc):
+        stage = nmc.stage
+        start = (nmc.snapshot(), stage.snapshot())
+        key = lambda: nmc.pos_stage + (nmc.state,)
+        seen = {key()}
+        rest = set()
+        queue = deque([start])
+        while queue:
+            snap, stage_snap = queue.popleft()
+            for move in MOVES:
+                stage.restore(stage_snap)
+                nmc.restore(snap)
+                if apply(nmc, move) and key() not in seen:
+                    seen.add(key())
+                    queue.append((nmc.snapshot(), stage.snapshot()))
+            stage.restore(stage_snap)
+            nmc.restore(snap)
+            x, y = nmc.pos_stage
+            if not nmc.pos_allowed(x, y+1):
+                rest.add((x, y, nmc.state))
+        stage.restore(start[1])
+        nmc.restore(start[0])
+        return rest
+    
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rng = random.Random(0)
+    gens = {n: nm.nMinoGen(n, background=False) for n in range(1, 6)}
+    total = 0
+    for t in range(trials):
+        stage = stg.Stage((0,0), 300, rng.choice([4, 10, 14]))
+        w, h = stage.gridsize
+        for i in range(rng.randrange(w*h//2)):
+            stage.add_obstacle((rng.randrange(w), rng.randrange(h//3, h)),
+                               blk.Block((1,1,1)))
+        try:
+            nmc = ctl.nMinoCtl(gens[rng.randrange(1, 6)].generate(), stage)
+        except ctl.GameOver:
+            continue
+        r = reach(nmc)
+        got = r.placements()
+        expected = brute(nmc)
+        if len(got) != len(set(got)) or set(got) != expected:
+            sys.exit("trial {}: placements differ at {}".format(
+                     t, sorted(set(got) ^ expected)[:5]))
+        for p in got[:10]:
+            snap, stage_snap = nmc.snapshot(), stage.snapshot()
+            if not all(apply(nmc, move) for move in r.path(*p)) or \
+               nmc.pos_stage + (nmc.state,) != p:
+                sys.exit("trial {}: path to {} doesn't get there".format(t, p))
+            stage.restore(stage_snap)
+            nmc.restore(snap)
+        total += len(got)
+    print("{} trials, {} placements ok".format(trials, total))
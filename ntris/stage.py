@@ -30,6 +30,36 @@ def stage_dims(width):
     return (width, 3*width//2)
 
 class Stage(ntris.ui.Area):
+    """
+    Stage - the playing field.
+    
+      BLOCK_ARRAY is the class storing the settled blocks, BlockArray,
+      PaletteBlockArray or ChunkedBlockArray.
+      
+      'tops' is the skyline: tops[x] is the row of the highest block in
+      column x (gridsize[1] if the column is empty). It is kept up to date
+      by add_obstacle, delete_rows and expand, so blocks have to be added
+      through add_obstacle.
+      
+      'active' is the index of the falling pieces of all players: one
+      bitmask per row, like BlockArray.masks, updated by nMinoCtl through
+      add_active / remove_active. 'collides' tests against both, so pieces
+      of different players cannot overlap; every test and update costs
+      O(piece rows) however many players there are.
+      
+      snapshot() and restore(snapshot) save and bring back the settled
+      blocks, the skyline and the active pieces. Snapshots share rows with
+      the stage (see BlockArray), so branching a search costs a pointer
+      copy per row plus a row copy per row written to. 'tops' and 'active'
+      are shared too, and copied on the first write after a snapshot. Row deletions still
+      being animated are not part of a snapshot.
+      
+      The settled blocks are drawn once into a layer surface and redrawn
+      row by row as add_obstacle, delete_rows and the row flashes change
+      them; expand, restore and set_block_array redraw the whole layer.
+      A frame is then a single blit of the layer.
+    """
+    BLOCK_ARRAY = BlockArray
     
     class StageRowPending:
         def __init__(self, rows, done, stage):
@@ -37,9 +67,8 @@ class Stage(ntris.ui.Area):
             self.step = 0
             def callback(t=None):
                 for r in rows:
-                    for b in stage.block_array[r]:
-                        if b:
-                            b.flash()
+                    stage.block_array.flash_row(r)
+                stage._dirty.update(rows)
                 if self.step == 4:
                     self.timer.deactivate()
                     stage.pending.remove(self)
@@ -48,9 +77,14 @@ class Stage(ntris.ui.Area):
                 self.step+= 1
             self.timer = ntris.utils.NormalTimer(callback, 70.0)
             self.timer.activate()
+            self.callback = callback
             
         def update(self, dt):
             self.timer.tick(dt)
+        
+        def finish(self):
+            while self.step <= 4:
+                self.callback()
     
     
     
@@ -63,8 +97,14 @@ class Stage(ntris.ui.Area):
         super().__init__(rect)
         
         gridsize  = stage_dims(grid_width)
-        self.block_array = BlockArray(gridsize, self._rect)
+        self.block_array = self.BLOCK_ARRAY(gridsize, self._rect)
         self.pending     = []
+        self.tops        = [gridsize[1]]*gridsize[0]
+        self.active      = [0]*gridsize[1]
+        self.nactive     = 0
+        self._shared     = False
+        self._layer      = None
+        self._dirty      = set()
 
     def stage2screen(self, *args):
         """
@@ -78,42 +118,235 @@ class Stage(ntris.ui.Area):
         """
         return self.block_array.coords2rect(self._rect, *args)
     
+    def screen_sizes(self, size):
+        """
+        screen_sizes(self, size)
+            Returns every size stage2screen(coords, 'size') can come out at.
+            Cell edges are rounded down to whole pixels, so each side may
+            be one pixel longer depending on 'coords': at most four sizes.
+        """
+        (cw, ch), (w, h) = self.block_array.size, self._rect.size
+        ws = {size[0]*w//cw, -(-size[0]*w//cw)}
+        hs = {size[1]*h//ch, -(-size[1]*h//ch)}
+        return [(sx, sy) for sx in ws for sy in hs]
+    
     def add_obstacle(self, pos, blk):
         blk.disable()
         self.block_array[pos] = blk
+        x,y = pos
+        self._dirty.add(y)
+        if y < self.tops[x]:
+            self._own_lines()
+            self.tops[x] = y
+    
+    def _scan_tops(self):
+        # Skyline of the whole stage in one pass over the row masks.
+        w, h = self.gridsize
+        tops = [h]*w
+        left = (1 << w) - 1
+        for y,m in enumerate(self.block_array.masks):
+            m &= left
+            left ^= m
+            while m:
+                low = m & -m
+                tops[low.bit_length()-1] = y
+                m ^= low
+            if not left:
+                break
+        return tops
+    
+    def _scan_top(self, x, y):
+        # Highest block of column x at row y or below.
+        masks = self.block_array.masks
+        while y < len(masks) and not masks[y] >> x & 1:
+            y+= 1
+        return y
     
     def obstructs(self, pos):
         return not 0 <= pos[0] < self.block_array.dims[0] or \
                not 0 <= pos[1] < self.block_array.dims[1] or \
                self.block_array.obstruction_at(pos)
+    
+    def collides(self, masks, x, y):
+        """
+        collides(self, masks, x, y)
+            Same as 'obstructs' for a whole piece given by row masks (see
+            BlockArray.collides and Rotations.masks), also taking the active
+            pieces into account.
+        """
+        if self.block_array.collides(masks, x, y):
+            return True
+        if self.nactive:
+            active = self.active
+            for i,m in enumerate(masks):
+                if active[y+i] & (m << x):
+                    return True
+        return False
+    
+    def _own_lines(self):
+        # Copies 'tops' and 'active' before they're written to, if they are
+        # shared with a snapshot.
+        if self._shared:
+            self.tops   = list(self.tops)
+            self.active = list(self.active)
+            self._shared = False
+    
+    def _toggle_active(self, masks, x, y):
+        self._own_lines()
+        active = self.active
+        for i,m in enumerate(masks):
+            active[y+i] ^= m << x
+    
+    def add_active(self, masks, x, y):
+        self._toggle_active(masks, x, y)
+        self.nactive+= 1
+    
+    def remove_active(self, masks, x, y):
+        self._toggle_active(masks, x, y)
+        self.nactive-= 1
+    
+    def drop_distance(self, masks, skirt, x, y):
+        """
+        drop_distance(self, masks, skirt, x, y)
+            Returns how many rows a piece can fall. 'masks' and 'skirt' are
+            its row masks and bottom profile (see Rotations), placed with
+            the left column at x and the top row at y.
+            
+            A piece above the skyline lands where the skyline says, in
+            O(piece width); a piece tucked under an overhang, or with an
+            active piece in its way, is moved down row by row.
+        """
+        tops = self.tops
+        d = min(tops[x+j] - y - s for j,s in enumerate(skirt)) - 1
+        if d > 0 and self.nactive:
+            span = ((1 << len(skirt)) - 1) << x
+            if any(m & span for m in self.active[y:y+len(masks)+d]):
+                d = -1
+        if d < 0:
+            d = 0
+            while not self.collides(masks, x, y+d+1):
+                d+= 1
+        return d
                
     def get_full_rows(self, rows=None):
-        rows = sorted(rows) if rows else range(self.gridsize[1])
-        return [r for r in rows if all(self.block_array[r])]
+        return self.block_array.full_rows(sorted(rows) if rows else None)
         
     def delete_rows(self, rows):
+        self._own_lines()
         for r in rows:
             self.block_array.delete_row(r)
+            tops = self.tops
+            for x in range(len(tops)):
+                if tops[x] < r:
+                    tops[x]+= 1
+                elif tops[x] == r:
+                    tops[x] = self._scan_top(x, r+1)
             for p in self.pending:
                 for i in range(len(p.rows)):
                     if p.rows[i] < i:
                         p.rows[i]-= 1
+            # Every row above r moved down by one.
+            self._dirty.update(range(r+1))
+    
+    def snapshot(self):
+        self._shared = True
+        return (self.block_array.snapshot(), self.tops, self.active,
+                self.nactive)
+    
+    def restore(self, snapshot):
+        array, tops, active, nactive = snapshot
+        self.block_array.restore(array)
+        self.tops    = tops
+        self.active  = active
+        self.nactive = nactive
+        self._shared = True
+        self._layer  = None
+    
+    def finish_pending(self):
+        """
+        finish_pending(self)
+            Deletes the rows being animated away at once, calling their
+            'done' callbacks.
+        """
+        for p in list(self.pending):
+            p.finish()
+    
+    def set_block_array(self, block_array):
+        """
+        set_block_array(self, block_array)
+            Replaces the settled blocks, e.g. when resuming a saved game.
+            Falling pieces have to be placed again.
+        """
+        self.block_array = block_array
+        self.pending = []
+        self.tops    = self._scan_tops()
+        self.active  = [0]*self.gridsize[1]
+        self._shared = False
+        self.nactive = 0
+        self._layer  = None
     
     def anim_delete(self, rows, done):
         self.pending.append(Stage.StageRowPending(rows, done, self))
     
     def expand(self, by):
         self.block_array.expand((by,3*by))
+        # Cells got smaller, no cached sprite has the right size any more.
+        Block.SPRITES.clear()
+        # Falling pieces keep their distance from the bottom.
+        self._own_lines()
+        self.active[:0] = [0]*(3*by)
+        self.tops = self._scan_tops()
+        self._layer = None
         
     def update(self, dt):
         for p in self.pending:
             p.update(dt)
     
+    @property
+    def needs_redraw(self):
+        # True if the settled blocks changed since the last 'draw'.
+        return self._layer is None or bool(self._dirty)
+    
+    def _draw_rows(self, rows):
+        # Redraws the given rows of the layer. '_shown' holds the row masks
+        # as last drawn, so rows that were and still are empty are skipped.
+        array = self.block_array
+        masks = array.masks
+        ref = self._layer.get_rect()
+        looks = set()
+        for y in rows:
+            m = masks[y]
+            if not m and not self._shown[y]:
+                continue
+            self._shown[y] = m
+            row = self._layer.subsurface(array.coords2rect(ref, (0,y), (array.dims[0],1)))
+            row.fill(self.bg)
+            while m:
+                low = m & -m
+                x = low.bit_length()-1
+                block = array[x,y]
+                looks.add(block.look())
+                block.draw(self._layer.subsurface(array.coords2rect(ref, (x,y))))
+                m ^= low
+            # Cells come in up to two widths and two heights.
+            Block.SPRITES.reserve(4*len(looks))
+    
     def draw(self, screen):
         super().draw(screen)
-        for block, rect in self.block_array.with_rects(self._rect):
-            block.draw(screen.subsurface(rect))          
+        if self._layer is None:
+            self._layer = pygame.Surface(self._rect.size, 0, screen)
+            self._layer.fill(self.bg)
+            self._shown = [0]*self.gridsize[1]
+            self._dirty = set(range(self.gridsize[1]))
+        if self._dirty:
+            self._draw_rows(sorted(self._dirty))
+            self._dirty.clear()
+        screen.blit(self._layer, self._rect)
 
+    @property
+    def zobrist(self):
+        return self.block_array.zobrist
+    
     @property
     def gridsize(self):
         return self.block_array.dims
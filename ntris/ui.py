@@ -22,6 +22,7 @@
 
 import pygame
 from pygame.locals import *
+import ntris.blocks
 import ntris.position
 import ntris.utils
 
@@ -48,11 +49,69 @@ class Area:
     @property
     def rect(self):
         return self._rect.copy()
+    
+    @property
+    def full_rect(self):
+        # Everything 'draw' touches, border included.
+        return ntris.position.rect_inflate(self._rect, 2, 2)
+
+class GlyphAtlas:
+    """
+    GlyphAtlas - the glyphs of a font, each rendered once per color and
+      scale.
+    
+      Strings are put together by blitting the cached glyphs side by side,
+      which gives the same pixels as rendering the whole string as long as
+      the font is monospaced and not antialiased (like PressStart2P).
+      Glyphs are kept in an LRU of 'maxsize': score popups come in the
+      color of the piece, so every new piece color brings new glyphs.
+    
+    Methods:
+      __init__(font, maxsize=1024)
+      glyph(c, color, scale)    : the surface of character 'c'
+      render(text, color, scale) : 'text' as a per-pixel alpha surface
+    """
+    def __init__(self, font, maxsize=1024):
+        self.font = font
+        self.glyphs = ntris.blocks.SpriteCache(maxsize)
+    
+    def glyph(self, c, color, scale):
+        return self.glyphs.get((c, tuple(color), scale),
+                               lambda: self._render(c, color, scale))
+    
+    def _render(self, c, color, scale):
+        glyph = self.font.render(c, False, color)
+        if scale:
+            w,h = glyph.get_size()
+            glyph = pygame.transform.scale(glyph, (int(scale[0]*w), int(scale[1]*h)))
+        return glyph
+    
+    def render(self, text, color, scale):
+        glyphs = [self.glyph(c, color, scale) for c in text]
+        sy = scale[1] if scale else 1
+        h = int(sy*self.font.get_height())
+        surf = pygame.Surface((sum(g.get_width() for g in glyphs), h), SRCALPHA)
+        x = 0
+        for g in glyphs:
+            surf.blit(g, (x,0))
+            x+= g.get_width()
+        return surf
 
 class Text:
+    """
+    Text - a line of text in the game's font.
+    
+      Characters come from the shared ATLAS and the finished surface is
+      kept per text, so a text that hasn't changed since its last draw
+      costs one blit. Up to MEMO looks of a text are kept (e.g. both colors
+      of a FlashingText).
+    """
     
     FONT_FILE = "assets/fonts/PressStart2P.ttf"
     FONT      = pygame.font.Font(FONT_FILE, 8)
+    ATLAS     = GlyphAtlas(FONT)
+    SHADE_COL = (100,100,100)
+    MEMO      = 16
     
     def __init__(self, txt, pos, **kwargs):
         self.color  = kwargs.get("color", [255,255,255])
@@ -63,20 +122,32 @@ class Text:
             raise ValueError("instance of ntris.position.Ref expected")
         self.text = txt
         self.pos = pos
+        self._memo = {}
         
     def draw(self, surface):
-        textsurf = Text.FONT.render(self.text, False, self._color)
-        if self.scale:
-            w,h = textsurf.get_size()
-            w,h = int(self.scale[0]*w), int(self.scale[1]*h)
-            textsurf = pygame.transform.scale(textsurf, (w,h))
-        rect = ntris.position.rect_align(textsurf.get_rect(), self.pos, self.ref)
+        key = self._look()
+        textsurf = self._memo.get(key)
+        if textsurf is None:
+            if len(self._memo) >= self.MEMO:
+                self._memo.clear()
+            textsurf = self._memo[key] = self._render()
+        surface.blit(textsurf, self.rect.topleft)
+    
+    def _render(self):
+        # The text with its shade, to be put at rect.topleft.
+        textsurf = Text.ATLAS.render(self.text, self._color, self.scale)
         if self.shade:
-            textsurf2 = textsurf.copy()
-            textsurf2.set_palette_at(1, [100,100,100])
             shift = max(self.scale)//2
-            surface.blit(textsurf2, rect.move(shift,shift).topleft)
-        surface.blit(textsurf, rect.topleft)
+            w,h = textsurf.get_size()
+            surf = pygame.Surface((w+shift, h+shift), SRCALPHA)
+            surf.blit(Text.ATLAS.render(self.text, self.SHADE_COL, self.scale),
+                      (shift,shift))
+            surf.blit(textsurf, (0,0))
+            textsurf = surf
+        return textsurf
+    
+    def _look(self):
+        return (self.text, tuple(self._color), self.scale, self.shade)
     
     def get_color(self):
         return self._color
@@ -85,11 +156,29 @@ class Text:
     color = property(get_color, set_color)
     
     def get_rect(self):
+        sx, sy = self.scale if self.scale else (1,1)
         rect = pygame.Rect((0,0), Text.FONT.size(self.text))
-        rect.size = (rect.w*self.scale[0], rect.h*self.scale[1])
+        rect.size = (int(rect.w*sx), int(rect.h*sy))
         rect = ntris.position.rect_align(rect, self.pos, self.ref)
         return rect
     rect = property(get_rect)
+    
+    @property
+    def dirty_rect(self):
+        # 'rect' together with the shade.
+        rect = self.rect
+        if self.shade:
+            shift = max(self.scale)//2
+            rect.union_ip(rect.move(shift,shift))
+        return rect
+    
+    def appearance(self):
+        """
+        appearance(self)
+            A key of everything that decides how the text looks: two texts
+            with equal keys draw the same pixels.
+        """
+        return self._look() + (tuple(self.pos), self.ref)
 
 class ScoreText(Text):
     
@@ -117,10 +206,12 @@ class ScoreText(Text):
                                  scale = self.scale,
                                  shade = self.shade)
         
-    def draw(self, surface):
-        rect = self.get_rect()
+    def _render(self):
+        # Digits are drawn into a surface of their own, so a score is only
+        # put together when it changes.
+        surf = pygame.Surface(self.dirty_rect.size, SRCALPHA)
         drect = self._digit_rect.copy()
-        drect.topleft = rect.topleft
+        drect.topleft = (0,0)
         fontfaces = [self._shaded_text, self._light_text]
         l = self.PADDING - len(str(self.score))
         
@@ -128,8 +219,12 @@ class ScoreText(Text):
             face = fontfaces[i>=l]
             face.text = c
             face.pos = drect.bottomright
-            face.draw(surface)
+            face.draw(surf)
             drect.topleft = drect.topright
+        return surf
+    
+    def _look(self):
+        return super()._look() + (self.score,)
         
     def get_rect(self):
         rect = self._digit_rect.copy()
@@ -137,6 +232,7 @@ class ScoreText(Text):
         rect = ntris.position.rect_align(rect, self.pos, self.ref)
         return rect
     rect = property(get_rect)
+    
 
     
 class FlashingText(Text):
@@ -165,6 +261,9 @@ class FlashingText(Text):
     def flash(self):
         self.timer.reset().activate()
     
+    def appearance(self):
+        return super().appearance() + (self.flashing,)
+    
     def tick(self, dt):
         self.timer.tick(dt)
     
@@ -0,0 +1,186 @@
+# MIT License
+#
+# Copyright (c) 2016 Marcin Zubilewicz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+64-bit Zobrist-style hashes of boards and pieces, and a transposition
+table to cache evaluations by them.
+
+Keys come from splitmix64, so they are the same in every process and run.
+A board row hashes to the XOR of the keys of its occupied columns; a board
+hashes to the XOR of its non-empty rows, each row mixed with the key of its
+height above the bottom. Setting a cell is then O(1), and deleting a row
+re-mixes the rows above it. Only occupancy is hashed, not colors.
+"""
+
+from enum import Enum
+
+MASK64 = (1 << 64) - 1
+
+def splitmix64(x):
+    x = (x + 0x9e3779b97f4a7c15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK64
+    return x ^ (x >> 31)
+
+_COLUMN = 0x636f6c756d6e0000
+_ROW    = 0x726f770000000000
+_PIECE  = 0x7069656365000000
+
+_column_keys = []
+
+def column_key(x):
+    while len(_column_keys) <= x:
+        _column_keys.append(splitmix64(_COLUMN + len(_column_keys)))
+    return _column_keys[x]
+
+def row_hash(mask):
+    """
+    row_hash(mask)
+        XOR of the column keys of the bits set in 'mask'.
+    """
+    h = 0
+    while mask:
+        low = mask & -mask
+        h ^= column_key(low.bit_length()-1)
+        mask ^= low
+    return h
+
+def mix_row(h, height):
+    """
+    mix_row(h, height)
+        Contribution to the board hash of a row with row_hash 'h' lying
+        'height' rows above the bottom. Empty rows contribute 0.
+    """
+    return splitmix64(h ^ splitmix64(_ROW + height)) if h else 0
+
+def board_hash(rowhashes):
+    """
+    board_hash(rowhashes)
+        Board hash from the row hashes, top row first.
+    """
+    n = len(rowhashes)
+    z = 0
+    for y,h in enumerate(rowhashes):
+        if h:
+            z ^= mix_row(h, n-1-y)
+    return z
+
+def fold(k):
+    """
+    fold(k)
+        Folds an int of any size into 64 bits.
+    """
+    h = splitmix64(k.bit_length())
+    while k:
+        h = splitmix64(h ^ (k & MASK64))
+        k >>= 64
+    return h
+
+def piece_hash(shape, state, x, y):
+    """
+    piece_hash(shape, state, x, y)
+        Hash of a falling piece: 'shape' is a fold()ed canonical key (see
+        Rotations.key), 'state' its rotation and (x,y) its stage position.
+    """
+    return splitmix64(shape ^ splitmix64(_PIECE + (state << 48) +
+                                         ((x & 0xffffff) << 24) + (y & 0xffffff)))
+
+class Replace(Enum):
+    """
+    Replace - what a TranspositionTable does when two keys share a slot.
+    
+      ALWAYS : the new entry wins,
+      DEPTH  : the entry searched deeper wins (ties go to the new one),
+      AGED   : like DEPTH, but entries from an older search (see
+               TranspositionTable.new_search) are always replaced.
+    """
+    ALWAYS = 1
+    DEPTH  = 2
+    AGED   = 3
+
+class TranspositionTable:
+    """
+    TranspositionTable - a fixed-size cache of values by 64-bit key.
+    
+      The table has 2**bits slots; a key goes to slot key & (2**bits-1),
+      and clashes are settled by the replacement policy. Lookups compare
+      full keys, so a clash never returns another position's value.
+    
+    Methods:
+      __init__(bits=16, policy=Replace.AGED)
+      get(key, depth=0) : the stored value if it was searched at least
+                          'depth' deep, otherwise None
+      put(key, value, depth=0)
+      new_search()      : starts a new generation for Replace.AGED
+      clear()
+    
+    Attributes:
+      hits, misses, stores, replaced : counters
+    """
+    def __init__(self, bits=16, policy=Replace.AGED):
+        if not isinstance(policy, Replace):
+            raise ValueError("instance of Replace expected")
+        self.size = 1 << bits
+        self.mask = self.size - 1
+        self.policy = policy
+        self.clear()
+    
+    def clear(self):
+        self.keys   = [None]*self.size
+        self.values = [None]*self.size
+        self.depths = [0]*self.size
+        self.ages   = [0]*self.size
+        self.age    = 0
+        self.hits = self.misses = self.stores = self.replaced = 0
+    
+    def new_search(self):
+        self.age+= 1
+    
+    def get(self, key, depth=0):
+        i = key & self.mask
+        if self.keys[i] == key and self.depths[i] >= depth:
+            self.hits+= 1
+            return self.values[i]
+        self.misses+= 1
+        return None
+    
+    def put(self, key, value, depth=0):
+        i = key & self.mask
+        old = self.keys[i]
+        if old is not None:
+            if self.policy != Replace.ALWAYS and depth < self.depths[i] and \
+               not (self.policy == Replace.AGED and self.ages[i] != self.age):
+                return False
+            if old != key:
+                self.replaced+= 1
+        self.keys[i]   = key
+        self.values[i] = value
+        self.depths[i] = depth
+        self.ages[i]   = self.age
+        self.stores+= 1
+        return True
+    
+    def __len__(self):
+        return self.size - self.keys.count(None)
+    
+    def __contains__(self, key):
+        return self.keys[key & self.mask] == key